@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+import argparse
+import contextlib
+import resource
+import sys
+import time
+import timeit
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import colour_gradient
+from util import calc
+from util import encoding
+
+
+THREADS = [100, 1000, 10000, 100000, 1000000]
+BASE_CASE = {
+    "n_threads": 10000,
+    "n_colours": 5,
+    "sigma_fraction": 0.25,
+    "max_jump": 50,
+    "max_tries": 1000,
+    "prefer_edges": False,
+}
+SWEEPS = {
+    "n_colours": [1, 2, 3, 4, 5],
+    "sigma_fraction": [0.05, 0.1, 0.25, 0.5, 1.0],
+    "max_jump": [1, 5, 50, 500],
+    "prefer_edges": [False, True],
+}
+# Colours too narrow to reach most of the warp, so that placement keeps
+# failing and fill_remaining has to take over
+ADVERSARIAL_CASES = [
+    dict(BASE_CASE, sigma_fraction=0.001, max_jump=2, max_tries=10),
+    dict(BASE_CASE, sigma_fraction=0.001, max_jump=2, max_tries=1000),
+    dict(BASE_CASE, sigma_fraction=0.01, max_jump=1, max_tries=100, prefer_edges=True),
+]
+SEED = 12345
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def make_config(case):
+    sigma = case["sigma_fraction"] * case["n_threads"] / case["n_colours"]
+    return colour_gradient.WarpConfig(n_threads=case["n_threads"], n_colours=case["n_colours"],
+                                      sigma=sigma, max_jump=case["max_jump"],
+                                      max_tries=case["max_tries"],
+                                      prefer_edges=case["prefer_edges"])
+
+
+def run_placement_case(case):
+    # Runs in a fresh worker process, so that the peak memory is that of this
+    # case alone
+    config = make_config(case)
+    stats = colour_gradient.PlacementStats()
+    memory_before = peak_memory_mb()
+    start = time.perf_counter()
+    colour_gradient.generate_placement(config, SEED, stats=stats)
+    elapsed = time.perf_counter() - start
+    return elapsed, peak_memory_mb() - memory_before, stats
+
+
+def placement_cases(max_threads):
+    cases = [dict(BASE_CASE, n_threads=n) for n in THREADS if n <= max_threads]
+    for name, values in SWEEPS.items():
+        cases += [dict(BASE_CASE, **{name: value}) for value in values
+                  if value != BASE_CASE[name]]
+    return cases
+
+
+def bench_placement(cases, label, out):
+    out.write(f"\n{label}\n")
+    out.write(f"{'threads':>9} {'colours':>7} {'sigma':>7} {'jump':>5} {'tries':>6} {'edges':>5} "
+              f"{'time [s]':>9} {'mem [MB]':>9} {'retries':>9} {'max tries':>9} {'fill at':>8}\n")
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+            elapsed, memory, stats = executor.submit(run_placement_case, case).result()
+        fill_at = "-" if stats.fill_remaining_at is None else stats.fill_remaining_at
+        out.write(f"{case['n_threads']:>9} {case['n_colours']:>7} {case['sigma_fraction']:>7} "
+                  f"{case['max_jump']:>5} {case['max_tries']:>6} {str(case['prefer_edges']):>5} "
+                  f"{elapsed:>9.3f} {memory:>9.1f} {stats.failed_tries:>9} "
+                  f"{stats.max_n_tries:>9} {fill_at:>8}\n")
+        out.flush()
+
+
+def time_call(func, number=None):
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def bench_internals(max_threads, out):
+    out.write("\nfind_closest_point / fill_remaining\n")
+    out.write(f"{'threads':>9} {'closest [us]':>13} {'fill [ms]':>10}\n")
+    rng = numpy.random.default_rng(SEED)
+    for n in THREADS:
+        if n > max_threads:
+            continue
+        # Every 100th position is left free, as late in a run
+        free_slots = colour_gradient.FreeSlots(n)
+        for p in range(n):
+            if p % 100:
+                free_slots.take(p)
+        suggestions = rng.integers(0, n, 1000).tolist()
+        closest = time_call(lambda: [colour_gradient.find_closest_point(s, 50, free_slots)
+                                     for s in suggestions]) / len(suggestions)
+
+        def fill():
+            placement = bytearray([encoding.EMPTY]) * n
+            free_slots = colour_gradient.FreeSlots(n)
+            n_threads_per_colour = calc.split_threads(n, 5, True, 2)
+            colour_gradient.fill_remaining(placement, [0] * 5, n_threads_per_colour, free_slots)
+        fill_time = time_call(fill, number=1)
+        out.write(f"{n:>9} {closest * 1e6:>13.2f} {fill_time * 1e3:>10.2f}\n")
+
+
+def bench_calc(max_threads, out):
+    out.write("\ncalc\n")
+    out.write(f"{'threads':>9} {'divisors':>10} {'split [us]':>11} {'cached [us]':>12} {'largest [us]':>13}\n")
+    # split_threads is memoized, so repeating a call only times the cache.
+    # The split itself is timed through the uncached function
+    split_uncached = calc._split_threads.__wrapped__
+    for n in THREADS:
+        if n > max_threads:
+            continue
+        # Two large coprime divisors make the stepwise search take longest
+        for n_batches, divisible_by in [(5, 2), (991, 997)]:
+            split = time_call(lambda: split_uncached(n, n_batches, True, divisible_by))
+            cached = time_call(lambda: calc.split_threads(n, n_batches, True, divisible_by))
+            largest = time_call(lambda: calc.largest_divisible_by_all(n, [divisible_by, n_batches]))
+            out.write(f"{n:>9} {f'{n_batches},{divisible_by}':>10} "
+                      f"{split * 1e6:>11.2f} {cached * 1e6:>12.2f} {largest * 1e6:>13.2f}\n")
+
+
+def main(command_line=None):
+    parser = argparse.ArgumentParser(description="Benchmark the placement and splitting algorithms",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "-m",
+        "--max_threads",
+        type=int,
+        default=max(THREADS),
+        help="skip warps wider than this"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="file to write the results to (default: stdout)"
+    )
+    args = parser.parse_args(command_line)
+
+    output = open(args.output, "w") if args.output else contextlib.nullcontext(sys.stdout)
+    with output as out:
+        out.write(f"seed={SEED} base case: {BASE_CASE}\n")
+        bench_placement(placement_cases(args.max_threads), "place_threads", out)
+        bench_placement(ADVERSARIAL_CASES, "place_threads, fill_remaining fallback", out)
+        bench_internals(args.max_threads, out)
+        bench_calc(args.max_threads, out)
+
+
+if __name__ == "__main__":
+    main()
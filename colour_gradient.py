@@ -1,7 +1,19 @@
 #!/usr/bin/env python
 
+import argparse
+import contextlib
+from array import array
+import heapq
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy
 import numpy.random
 from util import calc
+from util import encoding
+from util.cache import PlacementCache
+from util.palette import DEFAULT_PALETTE
 
 
 n_threads = 7
@@ -11,14 +23,62 @@ max_jump = 50
 max_tries = 1000
 pattern_size = 108.0
 max_per_line = 30.0
+min_block_rounds = 256
+max_block_rounds = 65536
+# Bump whenever a change to the placement algorithm changes what a given seed
+# produces, so that cached placements from older versions are not reused
+cache_version = 2
+score_window = 20
 PREFER_EDGES = False
-COLOURS = [
-    (65, 60, 90),
-    (180, 140, 175),
-    (225, 190, 200),
-    (250, 250, 225),
-    (250, 245, 155)
-]
+COLOURS = DEFAULT_PALETTE.colours
+
+
+class WarpConfig:
+    # Parameters for one warp design. Every function that places threads
+    # takes one of these instead of reading the module level defaults, so
+    # designs with different parameters can be generated in the same process
+    def __init__(self, n_threads=n_threads, n_colours=n_colours, sigma=sigma,
+                 max_jump=max_jump, max_tries=max_tries, prefer_edges=PREFER_EDGES):
+        # The plots and braid documents can only show as many colours as the
+        # palette has
+        if not 1 <= n_colours <= len(DEFAULT_PALETTE):
+            raise ValueError(f"n_colours must be between 1 and {len(DEFAULT_PALETTE)}, got {n_colours}")
+        self.n_threads = n_threads
+        self.n_colours = n_colours
+        self.sigma = sigma
+        self.max_jump = max_jump
+        self.max_tries = max_tries
+        self.prefer_edges = prefer_edges
+
+    def threads_per_colour(self):
+        return calc.split_threads(self.n_threads, self.n_colours, True, 2)
+
+
+class PlacementStats:
+    # Counters and phase timings filled in by place_threads when it is given
+    # one, to help tune sigma and max_jump. suggestions_drawn and out_of_range
+    # count the samples behind the suggestions that were used, including the
+    # out of range ones that were redrawn. fill_remaining_at is the number of
+    # threads that had been placed when fill_remaining took over, and
+    # fill_remaining_after the time in seconds from the start until then
+    def __init__(self):
+        self.suggestions_drawn = 0
+        self.out_of_range = 0
+        self.attempts = 0
+        self.collisions = 0
+        self.jump_distance_total = 0
+        self.jump_distance_max = 0
+        self.failed_tries = 0
+        self.max_n_tries = 0
+        self.fill_remaining_at = None
+        self.fill_remaining_after = None
+        self.phase_times = {}
+        self.start_time = None
+
+    def as_dict(self):
+        stats = dict(vars(self))
+        del stats["start_time"]
+        return stats
 
 
 def get_colour_centers(n_threads_per_colour):
@@ -27,23 +87,61 @@ def get_colour_centers(n_threads_per_colour):
     for colour_n_threads in n_threads_per_colour[1:-1]:
         colour_centers.append(moving_point + int(colour_n_threads/2.0))
         moving_point += colour_n_threads
-    colour_centers.append(n_threads)
+    colour_centers.append(sum(n_threads_per_colour))
     return colour_centers
 
 
-def find_closest_point(suggestion, max_jump, placement):
-    # Check backwards and forwards
-    closest_left = None
-    closest_right = None
-    for i in range(suggestion, max(0, suggestion - max_jump), -1):
-        if placement[i] is None:
-            closest_left = i
-            break
-    for i in range(suggestion, min(len(placement),
-                                   suggestion + max_jump), 1):
-        if placement[i] is None:
-            closest_right = i
-            break
+class FreeSlots:
+    # Keeps track of the empty positions in a placement with union-find style
+    # "next free" pointers in both directions, so that looking up the closest
+    # empty position or the first empty position does not need to scan the
+    # placement itself. Positions are taken with take(); they are never freed
+    def __init__(self, size):
+        self.size = size
+        self.n_free = size
+        # _right[i] points towards the first free position >= i, where size
+        # means "none". _left is shifted by one: _left[i + 1] points towards
+        # the last free position <= i, where 0 means "none". Kept as C ints,
+        # 4 bytes per position instead of a Python int object each
+        self._right = array("i", range(size + 1))
+        self._left = array("i", range(size + 1))
+
+    @staticmethod
+    def _find(parent, i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def take(self, position):
+        self._right[position] = position + 1
+        self._left[position + 1] = position
+        self.n_free -= 1
+
+    def next_free(self, position):
+        found = self._find(self._right, position)
+        return found if found < self.size else None
+
+    def previous_free(self, position):
+        found = self._find(self._left, position + 1)
+        return found - 1 if found > 0 else None
+
+    def first_free(self):
+        return self.next_free(0)
+
+
+def find_closest_point(suggestion, max_jump, free_slots):
+    # Check backwards and forwards. The window is the same as for the original
+    # scan, i.e. positions in (max(0, suggestion - max_jump), suggestion] to
+    # the left and [suggestion, suggestion + max_jump) to the right
+    closest_left = free_slots.previous_free(suggestion)
+    if closest_left is not None and closest_left <= max(0, suggestion - max_jump):
+        closest_left = None
+    closest_right = free_slots.next_free(suggestion)
+    if closest_right is not None and closest_right >= suggestion + max_jump:
+        closest_right = None
     if closest_left is None and closest_right is None:
         # If we have used up the threads for the colour closest
         # to the empty spot(s), then it'll be unlikely we fill
@@ -61,89 +159,395 @@ def find_closest_point(suggestion, max_jump, placement):
         return closest_right
 
 
-def fill_remaining(placement_in, colour_count, n_threads_per_colour):
+def fill_remaining(placement_in, colour_count, n_threads_per_colour, free_slots):
     # If we have used up the threads for the colour closest
     # to the empty spot(s), then it'll be unlikely we fill
     # them. Just use up the remaining threads if it comes
     # to that, using colour order to place "original" colour
     placement = placement_in
-    while sum(x is None for x in placement) > 0:
+    while free_slots.n_free > 0:
         for c in range(len(colour_count)):
-            colour_char = chr(65 + c)
             while colour_count[c] < n_threads_per_colour[c]:
-                for p in range(len(placement)):
-                    if placement[p] is None:
-                        placement[p] = colour_char
-                        colour_count[c] += 1
-                        break
+                p = free_slots.first_free()
+                placement[p] = c
+                free_slots.take(p)
+                colour_count[c] += 1
     return placement
 
 
-def place_one_thread(colour, n_threads_per_colour, colour_count_in,
-                     colour_centers, placement_in, n_tries_in):
+def draw_suggestions(mu, size, config, rng=numpy.random, count_redraws=False):
+    # Draw a whole block of suggestions at once. Samples that fall outside the
+    # warp are redrawn, which gives the same distribution as drawing one
+    # suggestion at a time and retrying until it is in range. With
+    # count_redraws, the number of out of range samples per suggestion is
+    # returned as well
+    mu = numpy.broadcast_to(numpy.asarray(mu, dtype=float), size).ravel()
+    suggestions = numpy.empty(mu.size, dtype=int)
+    redraws = numpy.zeros(mu.size, dtype=int) if count_redraws else None
+    pending = numpy.arange(mu.size)
+    while pending.size > 0:
+        drawn = rng.normal(mu[pending], config.sigma).astype(int)
+        in_range = (drawn >= 0) & (drawn < config.n_threads)
+        suggestions[pending[in_range]] = drawn[in_range]
+        pending = pending[~in_range]
+        if redraws is not None:
+            redraws[pending] += 1
+    if count_redraws:
+        return suggestions.reshape(size), redraws.reshape(size)
+    return suggestions.reshape(size)
+
+
+def place_one_thread(colour, suggestion, n_threads_per_colour, colour_count_in,
+                     placement_in, n_tries_in, free_slots, config, stats=None):
     colour_count = colour_count_in
     placement = placement_in
     n_tries = n_tries_in
-    colour_char = chr(65 + colour)
     if colour_count[colour] == n_threads_per_colour[colour]:
         return placement, colour_count, n_tries
-    mu = colour_centers[colour]
-    suggestion = -1
-    while suggestion < 0 or suggestion >= n_threads:
-        suggestion = int(numpy.random.normal(mu, sigma, 1))
-    if placement[suggestion] is None:
-        placement[suggestion] = colour_char
+    if stats is not None:
+        stats.attempts += 1
+    if placement[suggestion] == encoding.EMPTY:
+        placement[suggestion] = colour
+        free_slots.take(suggestion)
     else:
-        closest_point = find_closest_point(suggestion, max_jump,
-                                           placement)
+        closest_point = find_closest_point(suggestion, config.max_jump,
+                                           free_slots)
+        if stats is not None:
+            stats.collisions += 1
         if closest_point is None:
             # If we have used up the threads for the colour closest
             # to the empty spot(s), then it'll be unlikely we fill
             # them. Just use up the remaining threads if it comes
             # to that, using colour order to place "original" colour
             n_tries += 1
-            if n_tries > max_tries:
+            if stats is not None:
+                stats.failed_tries += 1
+                stats.max_n_tries = max(stats.max_n_tries, n_tries)
+            if n_tries > config.max_tries:
+                if stats is not None:
+                    stats.fill_remaining_at = config.n_threads - free_slots.n_free
+                    stats.fill_remaining_after = time.perf_counter() - stats.start_time
                 placement = fill_remaining(placement, colour_count,
-                                           n_threads_per_colour)
+                                           n_threads_per_colour, free_slots)
             return placement, colour_count, n_tries
-        placement[closest_point] = colour_char
+        placement[closest_point] = colour
+        free_slots.take(closest_point)
+        if stats is not None:
+            jump_distance = abs(closest_point - suggestion)
+            stats.jump_distance_total += jump_distance
+            stats.jump_distance_max = max(stats.jump_distance_max, jump_distance)
     n_tries = 0
     colour_count[colour] += 1
     return placement, colour_count, n_tries
 
 
-def place_threads(n_threads_per_colour, colour_centers, prefer_edges=False):
-    placement = [None] * n_threads
+def place_rounds(colours, n_threads_per_colour, colour_count_in,
+                 colour_centers, placement_in, n_tries_in, free_slots,
+                 config, rng=numpy.random, stats=None):
+    # Place one thread per colour and round until all given colours are used
+    # up. The suggestions for as many rounds as the busiest colour needs are
+    # drawn in one go (at least min_block_rounds, so the retries at the end of
+    # a run do not draw one round at a time, and at most max_block_rounds, so
+    # the block stays small next to the placement). Unused suggestions are
+    # dropped
+    colour_count = colour_count_in
+    placement = placement_in
+    n_tries = n_tries_in
+    mus = [colour_centers[colour] for colour in colours]
+
+    def n_left():
+        return max(n_threads_per_colour[c] - colour_count[c] for c in colours)
+
+    while n_left() > 0:
+        n_rounds = min(max(n_left(), min_block_rounds), max_block_rounds)
+        if stats is None:
+            block = draw_suggestions(mus, (n_rounds, len(colours)), config, rng)
+        else:
+            block, redraws = draw_suggestions(mus, (n_rounds, len(colours)), config, rng,
+                                              count_redraws=True)
+            redraws = redraws.tolist()
+        for i, row in enumerate(block.tolist()):
+            for j, (colour, suggestion) in enumerate(zip(colours, row)):
+                if stats is not None and colour_count[colour] < n_threads_per_colour[colour]:
+                    # Only the suggestions place_one_thread uses are counted
+                    stats.suggestions_drawn += 1 + redraws[i][j]
+                    stats.out_of_range += redraws[i][j]
+                placement, colour_count, n_tries = place_one_thread(colour,
+                                                                    suggestion,
+                                                                    n_threads_per_colour,
+                                                                    colour_count,
+                                                                    placement,
+                                                                    n_tries,
+                                                                    free_slots,
+                                                                    config,
+                                                                    stats)
+            if n_left() == 0:
+                break
+    return placement, colour_count, n_tries
+
+
+def place_threads(n_threads_per_colour, colour_centers, config, rng=numpy.random,
+                  stats=None):
+    if stats is not None:
+        stats.start_time = time.perf_counter()
+    n_colours = len(n_threads_per_colour)
+    # Filled in as a bytearray, which is cheap to index one thread at a time,
+    # and handed out as a uint8 array sharing the same memory
+    placement = bytearray([encoding.EMPTY]) * config.n_threads
+    free_slots = FreeSlots(config.n_threads)
     colour_count = [0] * n_colours
     n_tries = 0
     edge_offset = 0
-    if prefer_edges:
+    if config.prefer_edges:
         for i in range(0, int(n_colours/2.0)):
-            while colour_count[i] < n_threads_per_colour[i] or colour_count[-1-i] < n_threads_per_colour[-1-i]:
-                for colour in [i, n_colours - 1 - i]:
-                    placement, colour_count, n_tries = place_one_thread(colour,
-                                                                        n_threads_per_colour,
-                                                                        colour_count,
-                                                                        colour_centers,
-                                                                        placement,
-                                                                        n_tries)
-        edge_offset = 1
-    while sum(x is None for x in placement) > 0:
-        for colour in range(0+edge_offset, len(n_threads_per_colour)-edge_offset, 1):
-            placement, colour_count, n_tries = place_one_thread(colour,
-                                                                n_threads_per_colour,
-                                                                colour_count,
-                                                                colour_centers,
-                                                                placement,
-                                                                n_tries)
-    return placement
+            placement, colour_count, n_tries = place_rounds([i, n_colours - 1 - i],
+                                                            n_threads_per_colour,
+                                                            colour_count,
+                                                            colour_centers,
+                                                            placement,
+                                                            n_tries,
+                                                            free_slots,
+                                                            config,
+                                                            rng,
+                                                            stats)
+        # The colours the edge phase paired up are full already; an odd
+        # middle colour (the only colour, if there is just one) is not
+        edge_offset = n_colours // 2
+        if stats is not None:
+            stats.phase_times["edges"] = time.perf_counter() - stats.start_time
+    phase_start = time.perf_counter()
+    colours = list(range(0+edge_offset, len(n_threads_per_colour)-edge_offset, 1))
+    if colours:
+        placement, colour_count, n_tries = place_rounds(colours,
+                                                        n_threads_per_colour,
+                                                        colour_count,
+                                                        colour_centers,
+                                                        placement,
+                                                        n_tries,
+                                                        free_slots,
+                                                        config,
+                                                        rng,
+                                                        stats)
+    if stats is not None:
+        stats.phase_times["main"] = time.perf_counter() - phase_start
+    return numpy.frombuffer(placement, dtype=numpy.uint8)
+
 
+def score_placement(placement, n_threads_per_colour, window=score_window):
+    # Lower is better. The local colour mix (a moving average of the colour
+    # index over `window` threads) is compared with that of a perfectly sorted
+    # warp. Long runs of one colour (banding) are penalised on top, relative
+    # to the average number of threads per colour
+    colours = placement.astype(int)
+    ideal = numpy.repeat(numpy.arange(len(n_threads_per_colour)), n_threads_per_colour)
+    kernel = numpy.ones(window) / window
+    deviation = numpy.abs(numpy.convolve(colours, kernel, mode="same")
+                          - numpy.convolve(ideal, kernel, mode="same")).mean()
+    run_bounds = numpy.concatenate(([0],
+                                    numpy.flatnonzero(colours[1:] != colours[:-1]) + 1,
+                                    [len(colours)]))
+    run_lengths = numpy.diff(run_bounds)
+    banding = (run_lengths ** 2).sum() / len(colours) / numpy.mean(n_threads_per_colour)
+    return float(deviation + banding)
 
-def main():
-    n_threads_per_colour = calc.split_threads(n_threads, n_colours, True, 2)
+
+def cache_params(config, seed):
+    return {
+        "version": cache_version,
+        "n_threads": config.n_threads,
+        "n_threads_per_colour": config.threads_per_colour(),
+        "sigma": config.sigma,
+        "max_jump": config.max_jump,
+        "max_tries": config.max_tries,
+        "prefer_edges": config.prefer_edges,
+        "colours": COLOURS,
+        "seed": seed,
+    }
+
+
+def generate_placement(config, seed=None, cache=None, stats=None):
+    # Reentrant entry point: all state lives in the arguments and in a
+    # generator of its own, so any number of designs can be generated back to
+    # back or concurrently. `seed` may also be a numpy Generator. Only runs
+    # with an integer seed are reproducible, so only those use the cache. A
+    # placement taken from the cache leaves `stats` untouched
+    use_cache = cache is not None and isinstance(seed, int)
+    if use_cache:
+        placement = cache.get(cache_params(config, seed))
+        if placement is not None:
+            return placement
+    n_threads_per_colour = config.threads_per_colour()
     colour_centers = get_colour_centers(n_threads_per_colour)
-    placement = place_threads(n_threads_per_colour, colour_centers, PREFER_EDGES)
-    print(",".join(str(x) for x in placement))
+    placement = place_threads(n_threads_per_colour, colour_centers, config,
+                              numpy.random.default_rng(seed), stats)
+    if use_cache:
+        cache.put(cache_params(config, seed), placement)
+    return placement
+
+
+def generate_candidate(seed, config, cache=None):
+    placement = generate_placement(config, seed, cache)
+    return score_placement(placement, config.threads_per_colour()), seed, placement
+
+
+def _generate_candidate(args):
+    return generate_candidate(*args)
+
+
+def search_placements(config, n_candidates, n_best=1, seed=None, processes=None,
+                      cache=None):
+    # Generate n_candidates placements across a process pool and return the
+    # n_best of them as (score, seed, placement), best first. Every candidate
+    # has its own seed, derived from `seed`, so any of them can be recreated
+    # with generate_placement(config, seed)
+    seeds = numpy.random.SeedSequence(seed).generate_state(n_candidates).tolist()
+    jobs = ((s, config, cache) for s in seeds)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        candidates = executor.map(_generate_candidate, jobs, chunksize=max(1, n_candidates // 64))
+        return heapq.nsmallest(n_best, candidates, key=lambda c: c[0])
+
+
+def main(command_line=None):
+    parser = argparse.ArgumentParser(description="Generate a colour gradient warp",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=n_threads,
+        help="number of threads in the warp"
+    )
+    parser.add_argument(
+        "-c",
+        "--colours",
+        type=int,
+        default=n_colours,
+        help="number of colours in the gradient"
+    )
+    parser.add_argument(
+        "--sigma",
+        type=float,
+        default=sigma,
+        help="spread of each colour around its center, in threads"
+    )
+    parser.add_argument(
+        "--max_jump",
+        type=int,
+        default=max_jump,
+        help="how far a thread may move from a taken position"
+    )
+    parser.add_argument(
+        "--max_tries",
+        type=int,
+        default=max_tries,
+        help="failed placements in a row before the remaining threads are filled in order"
+    )
+    parser.add_argument(
+        "-e",
+        "--prefer_edges",
+        action="store_true",
+        default=PREFER_EDGES,
+        help="place the outer colours before the inner ones"
+    )
+    parser.add_argument(
+        "-n",
+        "--candidates",
+        type=int,
+        default=1,
+        help="number of candidate placements to generate and score"
+    )
+    parser.add_argument(
+        "-k",
+        "--best",
+        type=int,
+        default=1,
+        help="number of best candidates to print, best first"
+    )
+    parser.add_argument(
+        "-j",
+        "--processes",
+        type=int,
+        default=None,
+        help="number of worker processes (default: one per CPU)"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="seed for reproducible placements"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="file to write the placement(s) to (default: stdout)"
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=1 << 16,
+        help="number of threads written at a time"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="directory to cache seeded placements in"
+    )
+    parser.add_argument(
+        "--cache_size",
+        type=int,
+        default=256,
+        help="maximum size of the placement cache in MB"
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print placement statistics as JSON to stderr (single placement only)"
+    )
+    parser.add_argument(
+        "-b",
+        "--binary",
+        action="store_true",
+        help="write the placement as raw bytes, one per thread, instead of text"
+    )
+    args = parser.parse_args(command_line)
+    if args.binary and args.candidates > 1 and args.best > 1:
+        parser.error("--binary writes a single placement, use it with --best 1")
+
+    try:
+        config = WarpConfig(n_threads=args.threads, n_colours=args.colours, sigma=args.sigma,
+                            max_jump=args.max_jump, max_tries=args.max_tries,
+                            prefer_edges=args.prefer_edges)
+    except ValueError as e:
+        parser.error(str(e))
+    cache = None
+    if args.cache_dir:
+        cache = PlacementCache(args.cache_dir, max_bytes=args.cache_size * 2**20)
+    if args.candidates > 1:
+        candidates = search_placements(config, args.candidates, args.best,
+                                       args.seed, args.processes, cache)
+    else:
+        stats = PlacementStats() if args.stats else None
+        placement = generate_placement(config, args.seed, cache, stats)
+        candidates = [(None, args.seed, placement)]
+        if stats is not None:
+            print(json.dumps(stats.as_dict()), file=sys.stderr)
+
+    for score, seed, placement in candidates:
+        if score is not None:
+            print(f"score={score:.4f} seed={seed}", file=sys.stderr)
+    if args.binary:
+        encoding.save_placement(candidates[0][2], args.output or sys.stdout.buffer)
+        return
+    output = open(args.output, "w") if args.output else contextlib.nullcontext(sys.stdout)
+    with output as f:
+        for i, (score, seed, placement) in enumerate(candidates):
+            # A blank line between candidates, so that readers such as
+            # plt_warp.py take the first (best) one
+            if i:
+                f.write("\n")
+            encoding.write_placement(placement, f, block_size=args.block_size)
+            f.write("\n")
 
 
 if __name__ == "__main__":
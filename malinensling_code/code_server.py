@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from malinensling_code import ApiStats, DiscountCodes, GoogleSheet, RowIndex, SqliteStore, Wrap
+
+
+class WriteBatch:
+    # The writes collected during one flush interval. Requests wait on it
+    # until the writes are in the store, so that a reply means the code is
+    # stored
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        # Codes the store found to be used elsewhere in the meantime
+        self.rejected = set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error:
+            raise self.error
+
+
+class CodeServer:
+    # Keeps the store connection and an index of all codes in memory, and
+    # serves create/use requests from many threads. Writes are collected
+    # for flush_delay seconds and then stored with one append for the new
+    # codes and one batch update for the used ones. Codes are checked and
+    # marked as used in memory under a lock, so a code cannot be used twice
+    # through the server. Codes used with the command line script while the
+    # server runs are only caught if the store checks them (SqliteStore)
+    def __init__(self, discount_codes, flush_delay=0.05):
+        self.discount_codes = discount_codes
+        self.store = discount_codes.store
+        self.flush_delay = flush_delay
+        self.lock = threading.Condition()
+        self.codes = set()
+        self.code_rows = {}
+        self.row_indices = {}
+        self.n_rows = 0
+        self.pending_rows = []
+        self.pending_used = {}
+        self.batch = WriteBatch()
+        self.writer = None
+
+    def start(self):
+        self.store.connect()
+        with self.lock:
+            self._load_new_rows()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _load_new_rows(self):
+        # Codes are only ever appended, so fetch the rows below the last one
+        # loaded. These include the rows this server appended itself, but the
+        # codes already known are left alone, since their rows in memory may
+        # hold uses that are not written yet. Called with the lock held
+        rows = self.store.get_rows(self.n_rows)
+        for code_index, row in enumerate(rows, self.n_rows):
+            if row and row[RowIndex.CODE].lower() not in self.code_rows:
+                code = row[RowIndex.CODE].lower()
+                self.codes.add(code)
+                self.code_rows[code] = row
+                self.row_indices[code] = code_index
+        self.n_rows += len(rows)
+        return len(rows)
+
+    def create(self, name, scope, percentage):
+        with self.lock:
+            code = self.discount_codes._new_code(self.codes)
+            row = self.discount_codes._new_row(code, name, scope, percentage)
+            # Made before the row is stored, so that a code is never stored
+            # without its message
+            message = self.discount_codes._message_to_send(name, code, scope, percentage)
+            self.code_rows[code] = row
+            self.pending_rows.append(row)
+            batch = self._notify()
+        batch.wait()
+        return code, message
+
+    def use(self, code, name="", wraps=[], check_only=False):
+        # Returns an error message, or None if the code is valid (and used
+        # unless check_only)
+        code_lower = code.lower()
+        with self.lock:
+            if code_lower not in self.code_rows:
+                # Maybe created elsewhere since the rows were loaded
+                self._load_new_rows()
+            row = self.code_rows.get(code_lower)
+            if row is None:
+                return f"Code {code} doesn't exist"
+            error = self.discount_codes._check_code(code, row, name, wraps)
+            if error or check_only:
+                return error
+            used_row = list(row)
+            self.discount_codes._mark_used(used_row)
+            self.code_rows[code_lower] = used_row
+            self.pending_used[code_lower] = (row, used_row)
+            batch = self._notify()
+        batch.wait()
+        if code_lower in batch.rejected:
+            return f"Code {code} was used elsewhere in the meantime"
+        return None
+
+    def _notify(self):
+        # Called with the lock held after adding a write
+        self.lock.notify()
+        return self.batch
+
+    def _write_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending_rows and not self.pending_used:
+                    self.lock.wait()
+            # Let more writes come in before taking the batch
+            time.sleep(self.flush_delay)
+            with self.lock:
+                rows, self.pending_rows = self.pending_rows, []
+                used, self.pending_used = self.pending_used, {}
+                batch, self.batch = self.batch, WriteBatch()
+            try:
+                batch.rejected = self._write(rows, used)
+            except Exception as e:
+                batch.error = e
+                self._undo(rows, used)
+            batch.done.set()
+
+    def _write(self, rows, used):
+        # Returns the codes that could not be used
+        verbose_level = self.discount_codes.verbose_level
+        if rows:
+            # The rows end up below whatever is in the store, which may
+            # include rows added elsewhere. n_rows is left as it is, so that
+            # _load_new_rows still picks those up
+            first_index = self.store.append_rows(rows)
+            with self.lock:
+                for code_index, row in enumerate(rows, first_index):
+                    self.row_indices[row[RowIndex.CODE]] = code_index
+            if verbose_level:
+                print(f"{len(rows)} rows added")
+        if not used:
+            return set()
+        used_indices = self.store.use_rows({self.row_indices[code]: used_row for code, (_, used_row) in used.items()})
+        if verbose_level:
+            print(f"{len(used_indices)} codes used")
+        return {code for code in used if self.row_indices[code] not in used_indices}
+
+    def _undo(self, rows, used):
+        # Forget the writes of a failed batch, so that the codes can be
+        # created or used again
+        with self.lock:
+            for row in rows:
+                code = row[RowIndex.CODE]
+                if code not in self.row_indices:
+                    self.codes.discard(code)
+                    self.code_rows.pop(code, None)
+            for code, (row, _) in used.items():
+                self.code_rows[code] = row
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # POST /create {"name", "wraps", "discount"} -> {"code", "message"}
+    # POST /use and /check {"code", "name", "wraps"} -> {"code", "valid", "error"}
+    # GET /stats -> Google sheet request statistics, see ApiStats
+    server_version = "MalinenslingCodes"
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self._reply(404, {"error": f"Unknown path {self.path}"})
+        stats = getattr(self.server.code_server.store, "stats", None)
+        self._reply(200, stats.as_dict() if stats is not None else {})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or "{}")
+            wraps = [Wrap(wrap) for wrap in request.get("wraps", [])]
+            discount = int(request.get("discount", 10))
+        except (TypeError, ValueError) as e:
+            return self._reply(400, {"error": str(e)})
+
+        code_server = self.server.code_server
+        try:
+            if self.path == "/create":
+                if not isinstance(request.get("name"), str) or not request["name"].strip():
+                    return self._reply(400, {"error": "No name given"})
+                code, message = code_server.create(request["name"], wraps, discount)
+                return self._reply(200, {"code": code, "message": message})
+            if self.path in ["/use", "/check"]:
+                if not request.get("code"):
+                    return self._reply(400, {"error": "No code given"})
+                error = code_server.use(request["code"], request.get("name", ""), wraps,
+                                        check_only=self.path == "/check")
+                return self._reply(200, {"code": request["code"], "valid": error is None, "error": error})
+        except Exception as e:
+            return self._reply(500, {"error": str(e)})
+        self._reply(404, {"error": f"Unknown path {self.path}"})
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.code_server.discount_codes.verbose_level:
+            super().log_message(format, *args)
+
+
+def main(command_line=None):
+    sheet_env_variable_name = "GOOGLE_SHEET_ID"
+    parser = argparse.ArgumentParser(description="Serve malinensling discount codes over HTTP on the local machine",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "-s",
+        "--sheet_id",
+        default="$" + sheet_env_variable_name,
+        help="ID of Google sheet to interact with"
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0
+    )
+    parser.add_argument(
+        "-D",
+        "--database",
+        default=None,
+        help="SQLite database to keep the codes in instead of the Google sheet"
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on"
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=8765,
+        help="port to listen on"
+    )
+    parser.add_argument(
+        "--rate_limit",
+        type=int,
+        default=60,
+        help="maximum number of read and of write requests per minute to the Google sheet, 0 for no limit"
+    )
+    parser.add_argument(
+        "--flush_delay",
+        type=float,
+        default=0.05,
+        help="seconds to collect writes for before storing them in the store"
+    )
+    args = parser.parse_args(command_line)
+
+    if args.sheet_id == "$" + sheet_env_variable_name:
+        args.sheet_id = os.environ.get(sheet_env_variable_name)
+    if not args.sheet_id and not args.database:
+        print("\nNo Google sheet ID provided\n")
+        parser.print_help()
+        sys.exit(1)
+
+    if args.database:
+        store = SqliteStore(args.database, verbose_level=args.verbose)
+    else:
+        store = GoogleSheet(sheet_id=args.sheet_id, verbose_level=args.verbose, stats=ApiStats(),
+                            rate_limit=args.rate_limit)
+    code_server = CodeServer(DiscountCodes(store, verbose_level=args.verbose, quiet=True), flush_delay=args.flush_delay)
+    code_server.start()
+    print(f"{code_server.n_rows} rows loaded")
+
+    http_server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    http_server.code_server = code_server
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,22 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
+import csv
+import json
+from abc import ABC, abstractmethod
 from enum import IntEnum
 from strenum import StrEnum
 import time
 import os
+import random
+import sqlite3
 import sys
+import threading
 import uuid
 from datetime import datetime
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+# The Google client libraries take long to import, so they are only imported
+# once they are needed, which e.g. --help never does
 
 
 # If modifying these scopes, delete the file token.json.
@@ -40,18 +45,279 @@ class RowIndex(IntEnum):
     DATE_USED = 7
 
 
-class GoogleSheet:
-    def __init__(self, sheet_id, sheet_tab="Codes", token_file="token.json", credentials_file="credentials.json", verbose_level=0, quiet=False):
+class CodeStore(ABC):
+    # Where the codes are kept: one row per code, laid out as in RowIndex and
+    # indexed from 0 in the order the rows were added
+    def connect(self):
+        pass
+
+    @abstractmethod
+    def get_rows(self, first_index=0):
+        # The current rows from first_index on
+        raise NotImplementedError
+
+    def codes(self):
+        # All existing codes, in lower case
+        return {row[RowIndex.CODE].lower() for row in self.get_rows() if row}
+
+    def find_code(self, code):
+        # Index of the row holding code and the current row, or None
+        current_data = self.get_rows()
+        current_codes = [row[RowIndex.CODE].lower() if row else "" for row in current_data]
+        code_lower = code.lower()
+        if code_lower not in current_codes:
+            return None
+        code_index = current_codes.index(code_lower)
+        return code_index, current_data[code_index]
+
+    def find_codes(self, codes):
+        # Like find_code for many codes at once, from one snapshot of the
+        # rows. Maps each code found, in lower case, to (index, row)
+        codes = {code.lower() for code in codes}
+        return {row[RowIndex.CODE].lower(): (code_index, row) for code_index, row in enumerate(self.get_rows())
+                if row and row[RowIndex.CODE].lower() in codes}
+
+    @abstractmethod
+    def append_rows(self, rows):
+        # Returns the index of the first row added
+        raise NotImplementedError
+
+    @abstractmethod
+    def use_rows(self, rows):
+        # Store rows, which maps row index to a row that has just been marked
+        # as used. Returns the indices of the rows that were stored, leaving
+        # out any the store knows to have been used in the meantime
+        raise NotImplementedError
+
+
+class SheetMirror:
+    # Local copy of the rows of a sheet tab, kept in a JSON file between runs,
+    # with an index from code to row. Codes are only ever appended to the
+    # sheet, so a sync only fetches the rows below the last one already known.
+    # Rows changed in place (codes being used) are not picked up by a sync, so
+    # use fetch_row() to get the current state of a row before acting on it
+    def __init__(self, filename, sheet_id, sheet_tab):
+        self.filename = filename
+        self.sheet_id = sheet_id
+        self.sheet_tab = sheet_tab
+        self.rows = []
+        self.index = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            # A mirror of another sheet is of no use, so start over in that case
+            if data.get("sheet_id") == sheet_id and data.get("sheet_tab") == sheet_tab:
+                self._add_rows(data.get("rows", []))
+
+    def _add_rows(self, rows):
+        for row in rows:
+            if row:
+                self.index[row[RowIndex.CODE].lower()] = len(self.rows)
+            self.rows.append(row)
+
+    def save(self):
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump({"sheet_id": self.sheet_id, "sheet_tab": self.sheet_tab, "rows": self.rows}, f)
+        os.replace(tmp_filename, self.filename)
+
+    def _range(self, first_row, last_row=""):
+        return f"{self.sheet_tab}!A{first_row}:{chr(len(RowIndex)-1+65)}{last_row}"
+
+    def sync(self, sheet):
+        new_rows = sheet.values().get(spreadsheetId=self.sheet_id,
+                                      range=self._range(len(self.rows) + 1)).execute().get("values", [])
+        if new_rows:
+            self._add_rows(new_rows)
+            self.save()
+        return len(new_rows)
+
+    def find(self, code):
+        # Index of the row holding code and the row itself, or None
+        index = self.index.get(code.lower())
+        if index is None:
+            return None
+        return index, self.rows[index]
+
+    def fetch_row(self, sheet, index):
+        rows = sheet.values().get(spreadsheetId=self.sheet_id,
+                                  range=self._range(index + 1, index + 1)).execute().get("values", [[]])
+        self.update_row(index, rows[0])
+        return rows[0]
+
+    def update_row(self, index, row):
+        self.update_rows({index: row})
+
+    def update_rows(self, rows):
+        # rows maps row index to row
+        for index, row in rows.items():
+            self.rows[index] = list(row)
+        self.save()
+
+
+class ApiStats:
+    # Call counts, time spent and payload sizes per kind of Sheets API call
+    # (get, append, update, batchUpdate), and for logging in and connecting.
+    # seconds is the time spent on the calls themselves and wait_seconds the
+    # time spent waiting for the rate limit or before retrying. Calls may be
+    # added from many threads, e.g. by code_server.py
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds, rows=0, request_bytes=0, response_bytes=0, wait_seconds=0.0, retries=0, failed=False):
+        with self.lock:
+            call = self.calls.setdefault(name, {"count": 0, "failed": 0, "retries": 0, "seconds": 0.0,
+                                                "max_seconds": 0.0, "wait_seconds": 0.0, "rows": 0,
+                                                "request_bytes": 0, "response_bytes": 0})
+            call["count"] += 1
+            call["failed"] += int(failed)
+            call["retries"] += retries
+            call["seconds"] += seconds
+            call["max_seconds"] = max(call["max_seconds"], seconds)
+            call["wait_seconds"] += wait_seconds
+            call["rows"] += rows
+            call["request_bytes"] += request_bytes
+            call["response_bytes"] += response_bytes
+
+    def as_dict(self):
+        with self.lock:
+            return {name: dict(call) for name, call in self.calls.items()}
+
+
+class RateLimiter:
+    # Lets at most max_calls calls through in any period seconds and makes
+    # the others wait, to stay within the Sheets API quota of requests per
+    # minute. max_calls=0 means no limit
+    def __init__(self, max_calls, period=60.0):
+        self.max_calls = max_calls
+        self.period = period
+        self.times = collections.deque()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # Returns the time waited
+        if not self.max_calls:
+            return 0.0
+        # Waiting with the lock held lets the waiting threads through in turn
+        with self.lock:
+            now = time.monotonic()
+            while self.times and self.times[0] <= now - self.period:
+                self.times.popleft()
+            wait = 0.0
+            if len(self.times) >= self.max_calls:
+                wait = self.times.popleft() + self.period - now
+                time.sleep(wait)
+            self.times.append(now + wait)
+        return wait
+
+
+class ApiRequest:
+    # Wraps a googleapiclient HttpRequest, so that execute() keeps to the
+    # rate limit, retries with exponential backoff when the quota is used up
+    # anyway (HTTP 429) and adds the call to stats
+    def __init__(self, http_request, stats=None, rate_limiter=None, max_retries=5, backoff=1.0):
+        self.http_request = http_request
+        self.name = http_request.methodId.split(".")[-1]
+        self.stats = stats
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.response_bytes = 0
+        postproc = http_request.postproc
+
+        def counting_postproc(resp, content):
+            self.response_bytes += len(content)
+            return postproc(resp, content)
+        http_request.postproc = counting_postproc
+
+    def __getattr__(self, name):
+        return getattr(self.http_request, name)
+
+    def execute(self, **kwargs):
+        from googleapiclient.errors import HttpError
+
+        wait_seconds = 0.0
+        for retries in range(self.max_retries + 1):
+            if self.rate_limiter:
+                wait_seconds += self.rate_limiter.wait()
+            start = time.perf_counter()
+            try:
+                result = self.http_request.execute(**kwargs)
+                break
+            except HttpError as e:
+                if e.resp.status != 429 or retries == self.max_retries:
+                    self._add(time.perf_counter() - start, {}, wait_seconds, retries, failed=True)
+                    raise
+            # Quota used up: wait 1, 2, 4, ... times backoff seconds, with
+            # some jitter so that waiting threads don't all retry at once
+            delay = self.backoff * 2**retries * (1 + random.random()) / 2
+            time.sleep(delay)
+            wait_seconds += delay
+        self._add(time.perf_counter() - start, result, wait_seconds, retries)
+        return result
+
+    def _add(self, seconds, result, wait_seconds, retries, failed=False):
+        if self.stats is None:
+            return
+        # The number of rows read or written
+        rows = len(result.get("values", [])) or result.get("updatedRows") or result.get("totalUpdatedRows") \
+            or result.get("updates", {}).get("updatedRows", 0)
+        self.stats.add(self.name, seconds, rows=rows, request_bytes=len(self.http_request.body or ""),
+                       response_bytes=self.response_bytes, wait_seconds=wait_seconds, retries=retries,
+                       failed=failed)
+
+
+def _values_only(document):
+    # Cut the Sheets API discovery document down to spreadsheets.values and
+    # the schemas it refers to
+    spreadsheets = document["resources"]["spreadsheets"]
+    document["resources"] = {"spreadsheets": {"resources": {"values": spreadsheets["resources"]["values"]}}}
+
+    def refs(item):
+        if isinstance(item, dict):
+            for key, value in item.items():
+                if key == "$ref":
+                    yield value
+                else:
+                    yield from refs(value)
+        elif isinstance(item, list):
+            for value in item:
+                yield from refs(value)
+
+    schemas = set()
+    to_visit = list(refs(document["resources"]))
+    while to_visit:
+        name = to_visit.pop()
+        if name not in schemas:
+            schemas.add(name)
+            to_visit += refs(document["schemas"][name])
+    document["schemas"] = {name: schema for name, schema in document["schemas"].items() if name in schemas}
+    return document
+
+
+class GoogleSheet(CodeStore):
+    def __init__(self, sheet_id, sheet_tab="Codes", token_file="token.json", credentials_file="credentials.json", verbose_level=0, mirror_file=None, discovery_file="sheets_v4.json", stats=None, rate_limit=60):
         self.sheet_id = sheet_id
         self.sheet_tab = sheet_tab
         self.token_file = token_file
         self.credentials_file = credentials_file
+        self.discovery_file = discovery_file
         self.verbose_level = verbose_level
-        self.quiet = quiet
         self.credentials = None
         self.sheet = None
+        self.mirror = SheetMirror(mirror_file, sheet_id, sheet_tab) if mirror_file else None
+        self.local = threading.local()
+        self.stats = stats
+        # The Sheets API has separate quotas for reading and writing
+        self.rate_limiters = {"read": RateLimiter(rate_limit), "write": RateLimiter(rate_limit)}
     
     def login(self):
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+
+        start = time.perf_counter()
         creds = None
         # The file token.json stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first
@@ -70,26 +336,399 @@ class GoogleSheet:
             with open(self.token_file, 'w') as token:
                 token.write(creds.to_json())
         self.credentials = creds
+        if self.stats is not None:
+            self.stats.add("login", time.perf_counter() - start)
 
     def connect_to_sheet_service(self):
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.http import HttpRequest
+
         if not self.credentials:
             self.login()
 
-        service = build('sheets', 'v4', credentials=self.credentials)
+        start = time.perf_counter()
+
+        def request_builder(http, *args, **kwargs):
+            http_request = HttpRequest(self._http(), *args, **kwargs)
+            rate_limiter = self.rate_limiters["read" if http_request.method == "GET" else "write"]
+            return ApiRequest(http_request, self.stats, rate_limiter)
+
+        service = build_from_document(self._discovery_document(), credentials=self.credentials,
+                                      requestBuilder=request_builder)
 
         # Call the Sheets API
         self.sheet = service.spreadsheets()
-    
-    def create_new_code(self, name="", scope=[], percentage=10):
+        if self.stats is not None:
+            self.stats.add("connect", time.perf_counter() - start)
+
+    def _http(self):
+        # Each thread keeps its connection open for the next request, since
+        # httplib2 connections cannot be shared between threads
+        if not hasattr(self.local, "http"):
+            from google_auth_httplib2 import AuthorizedHttp
+            from googleapiclient.http import build_http
+            self.local.http = AuthorizedHttp(self.credentials, http=build_http())
+        return self.local.http
+
+    def _discovery_document(self):
+        # Building the service from the whole Sheets API discovery document
+        # takes longer than anything else in a run, so a copy cut down to the
+        # parts used here is kept in discovery_file. Delete the file to get a
+        # new copy, e.g. after upgrading google-api-python-client
+        if os.path.exists(self.discovery_file):
+            with open(self.discovery_file) as f:
+                return f.read()
+        from googleapiclient.discovery_cache import get_static_doc
+        document = json.dumps(_values_only(json.loads(get_static_doc("sheets", "v4"))))
+        tmp_filename = self.discovery_file + ".tmp"
+        with open(tmp_filename, "w") as f:
+            f.write(document)
+        os.replace(tmp_filename, self.discovery_file)
+        return document
+
+    def connect(self):
         if not self.sheet:
             self.connect_to_sheet_service()
 
-        current_data = self.sheet.values().get(spreadsheetId=self.sheet_id,
-                                               range=self.sheet_tab).execute()
-        current_codes = [row[RowIndex.CODE] for row in current_data.get("values", [])]
+    def get_rows(self, first_index=0):
+        if first_index:
+            range = self._row_range(first_index + 1, "")
+        else:
+            range = self.sheet_tab
+        return self.sheet.values().get(spreadsheetId=self.sheet_id,
+                                       range=range).execute().get("values", [])
+
+    def _get_rows(self):
+        # With a mirror only the rows added since the last sync are downloaded
+        if self.mirror:
+            n_new_rows = self.mirror.sync(self.sheet)
+            if self.verbose_level:
+                print(f"Mirror synced; {n_new_rows} new rows")
+            return self.mirror.rows
+        return self.get_rows()
+
+    def codes(self):
+        return {row[RowIndex.CODE].lower() for row in self._get_rows() if row}
+
+    def find_code(self, code):
+        if self.mirror:
+            # Only sync when the code is not known yet, since codes once added
+            # never move
+            found = self.mirror.find(code)
+            if found is None:
+                self._get_rows()
+                found = self.mirror.find(code)
+                if found is None:
+                    return None
+            # The row may have been used elsewhere since it was mirrored
+            code_index, _ = found
+            return code_index, self.mirror.fetch_row(self.sheet, code_index)
+        return super().find_code(code)
+
+    def append_rows(self, rows):
+        result = self.sheet.values().append(spreadsheetId=self.sheet_id,
+                                            body={"values": rows},
+                                            range=self.sheet_tab,
+                                            valueInputOption="USER_ENTERED").execute()
+        # The rows end up below whatever is in the sheet, e.g. "Codes!A7:H9"
+        first_cell = result["updates"]["updatedRange"].split("!")[-1].split(":")[0]
+        return int(first_cell.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")) - 1
+
+    def use_rows(self, rows):
+        # The sheet cannot check that the rows are still unused as it writes
+        self.write_rows(rows)
+        if self.mirror:
+            self.mirror.update_rows(rows)
+        return list(rows)
+
+    def write_rows(self, rows):
+        # rows maps row index to row
+        if len(rows) == 1:
+            [(code_index, code_info)] = rows.items()
+            range = self._row_range(code_index + 1)
+            if self.verbose_level:
+                print(f"Updating {range} with info={code_info}")
+            self.sheet.values().update(spreadsheetId=self.sheet_id,
+                                       body={"values": [code_info]},
+                                       range=range,
+                                       valueInputOption="USER_ENTERED").execute()
+            return
+        data = [{"range": self._row_range(code_index + 1), "values": [code_info]}
+                for code_index, code_info in rows.items()]
+        if self.verbose_level:
+            print(f"Updating {len(data)} rows: ", data)
+        self.sheet.values().batchUpdate(spreadsheetId=self.sheet_id,
+                                        body={"valueInputOption": "USER_ENTERED", "data": data}).execute()
+
+    def _row_range(self, row_number, last_row_number=None):
+        # last_row_number="" gives all rows from row_number on
+        if last_row_number is None:
+            last_row_number = row_number
+        return self.sheet_tab + f"!A{row_number}:{chr(len(RowIndex)-1+65)}{last_row_number}"
+
+
+class SqliteStore(CodeStore):
+    # Codes kept in a local SQLite database, indexed on the code so that
+    # lookups stay fast however many codes there are. A code is only marked
+    # as used if it is still unused, in the same transaction, so it can never
+    # be used twice. Each row remembers where it is in the Google sheet the
+    # database is synced with (sheet_row, NULL until the row is appended
+    # there) and whether it was used since the last sync_to_sheet()
+    COLUMNS = [index.name.lower() for index in RowIndex]
+    # The lowest limit on query parameters of any SQLite version
+    MAX_PARAMETERS = 999
+
+    def __init__(self, filename, verbose_level=0):
+        self.filename = filename
+        self.verbose_level = verbose_level
+        self.connection = None
+        # One connection is shared between threads, e.g. by code_server.py
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection:
+            return
+        self.connection = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+        columns = ", ".join(f"{column} TEXT NOT NULL DEFAULT ''" for column in self.COLUMNS)
+        self.connection.execute(f"CREATE TABLE IF NOT EXISTS codes (row INTEGER PRIMARY KEY, {columns}, "
+                                f"sheet_row INTEGER, synced INTEGER NOT NULL DEFAULT 0)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS codes_code ON codes (code COLLATE NOCASE)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS codes_synced ON codes (synced)")
+        # Number of sheet rows loaded into the database so far
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sheet (n_rows INTEGER NOT NULL)")
+        self.connection.execute("INSERT INTO sheet (n_rows) SELECT 0 WHERE NOT EXISTS (SELECT * FROM sheet)")
+
+    def get_rows(self, first_index=0):
+        with self.lock:
+            result = self.connection.execute(f"SELECT row, {', '.join(self.COLUMNS)} FROM codes "
+                                             f"WHERE row >= ? ORDER BY row", (first_index,)).fetchall()
+        # Gaps in the row indices are kept as empty rows, so that positions
+        # in the list stay row indices
+        rows = []
+        for code_index, *row in result:
+            rows += [[]] * (code_index - first_index - len(rows))
+            rows.append(row)
+        return rows
+
+    def codes(self):
+        with self.lock:
+            return {code.lower() for code, in self.connection.execute("SELECT code FROM codes")}
+
+    def find_code(self, code):
+        with self.lock:
+            result = self.connection.execute(f"SELECT row, {', '.join(self.COLUMNS)} FROM codes "
+                                             f"WHERE code = ? COLLATE NOCASE LIMIT 1", (code,)).fetchone()
+        if result is None:
+            return None
+        code_index, *row = result
+        return code_index, row
+
+    def find_codes(self, codes):
+        # Looked up through the index in chunks, since a query can only
+        # take so many parameters
+        codes = list({code.lower() for code in codes})
+        found = {}
+        with self.lock:
+            for start in range(0, len(codes), self.MAX_PARAMETERS):
+                chunk = codes[start:start + self.MAX_PARAMETERS]
+                result = self.connection.execute(f"SELECT row, {', '.join(self.COLUMNS)} FROM codes "
+                                                 f"WHERE code COLLATE NOCASE IN ({', '.join(['?'] * len(chunk))}) "
+                                                 f"ORDER BY row", chunk).fetchall()
+                for code_index, *row in result:
+                    found.setdefault(row[RowIndex.CODE].lower(), (code_index, row))
+        return found
+
+    def append_rows(self, rows):
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            first_index, = self.connection.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM codes").fetchone()
+            self._insert_rows(enumerate(rows, first_index), synced=False)
+        return first_index
+
+    def _insert_rows(self, rows, synced):
+        # rows is a sequence of (row index, row)
+        placeholders = ", ".join(["?"] * (len(self.COLUMNS) + 2))
+        self.connection.executemany(f"INSERT OR REPLACE INTO codes (row, {', '.join(self.COLUMNS)}, synced) "
+                                    f"VALUES ({placeholders})",
+                                    [(code_index, *self._padded(row), int(synced)) for code_index, row in rows])
+
+    def use_rows(self, rows):
+        used = []
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            for code_index, code_info in rows.items():
+                cursor = self.connection.execute("UPDATE codes SET t_used = ?, date_used = ?, synced = 0 "
+                                                 "WHERE row = ? AND t_used = ''",
+                                                 (str(code_info[RowIndex.T_USED]), code_info[RowIndex.DATE_USED],
+                                                  code_index))
+                if cursor.rowcount:
+                    used.append(code_index)
+        return used
+
+    def n_sheet_rows(self):
+        with self.lock:
+            n_rows, = self.connection.execute("SELECT n_rows FROM sheet").fetchone()
+        return n_rows
+
+    def load_sheet_rows(self, rows, first_sheet_row):
+        # Add the rows read from the sheet from first_sheet_row on below the
+        # rows of the database, as synced. Rows this database appended to the
+        # sheet itself are already there. A code that is in the sheet and was
+        # also created in the database without being appended yet would end
+        # up twice, so nothing is loaded then
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            first_index, = self.connection.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM codes").fetchone()
+            new_rows = []
+            for sheet_row, row in enumerate(rows, first_sheet_row):
+                if not row:
+                    continue
+                known = self.connection.execute("SELECT sheet_row FROM codes WHERE code = ? COLLATE NOCASE LIMIT 1",
+                                                (row[RowIndex.CODE],)).fetchone()
+                if known is None:
+                    new_rows.append((first_index + len(new_rows), sheet_row, row))
+                elif known[0] is None:
+                    raise ValueError(f"Code {row[RowIndex.CODE]} is in sheet row {sheet_row + 1} and was also "
+                                     f"created in the database; remove one of them and sync again")
+            placeholders = ", ".join(["?"] * (len(self.COLUMNS) + 3))
+            self.connection.executemany(f"INSERT INTO codes (row, {', '.join(self.COLUMNS)}, sheet_row, synced) "
+                                        f"VALUES ({placeholders})",
+                                        [(code_index, *self._padded(row), sheet_row, 1)
+                                         for code_index, sheet_row, row in new_rows])
+            self.connection.execute("UPDATE sheet SET n_rows = ?", (first_sheet_row + len(rows),))
+        return len(new_rows)
+
+    def unappended_rows(self):
+        # The rows that are not in the sheet yet, as {row index: row}
+        with self.lock:
+            result = self.connection.execute(f"SELECT row, {', '.join(self.COLUMNS)} FROM codes "
+                                             f"WHERE sheet_row IS NULL ORDER BY row").fetchall()
+        return {code_index: row for code_index, *row in result}
+
+    def mark_appended(self, rows, first_sheet_row):
+        # rows were appended to the sheet in this order from first_sheet_row
+        # on. Rows used in the meantime stay unsynced. If nothing was added
+        # to the sheet since it was loaded, the rows need not be loaded back
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany("UPDATE codes SET sheet_row = ?, synced = (t_used = ?) WHERE row = ?",
+                                        [(sheet_row, row[RowIndex.T_USED], code_index)
+                                         for sheet_row, (code_index, row) in enumerate(rows.items(), first_sheet_row)])
+            self.connection.execute("UPDATE sheet SET n_rows = ? WHERE n_rows = ?",
+                                    (first_sheet_row + len(rows), first_sheet_row))
+
+    def unsynced_rows(self):
+        # The rows in the sheet that were used since the last sync, as
+        # {row index: (sheet row index, row)}
+        with self.lock:
+            result = self.connection.execute(f"SELECT row, sheet_row, {', '.join(self.COLUMNS)} FROM codes "
+                                             f"WHERE synced = 0 AND sheet_row IS NOT NULL ORDER BY row").fetchall()
+        return {code_index: (sheet_row, row) for code_index, sheet_row, *row in result}
+
+    def mark_synced(self, rows):
+        # rows is as returned by unsynced_rows(). A row is only ever changed
+        # by being used, so rows used again since they were read (which
+        # cannot happen) or in between stay unsynced
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany("UPDATE codes SET synced = 1 WHERE row = ? AND t_used = ?",
+                                        [(code_index, row[RowIndex.T_USED])
+                                         for code_index, (_, row) in rows.items()])
+
+    @staticmethod
+    def _padded(row):
+        return [str(value) for value in row] + [""] * (len(RowIndex) - len(row))
+
+
+def sync_to_sheet(database, sheet):
+    # Bring the database and the sheet together: the rows added to the sheet
+    # since the last sync are loaded into the database (on the first sync,
+    # the whole sheet), the codes created in the database are appended to
+    # the sheet and the codes used in the database are written to their rows
+    # in the sheet. Returns the numbers of rows loaded, appended and updated
+    database.connect()
+    sheet.connect()
+    first_sheet_row = database.n_sheet_rows()
+    n_loaded = database.load_sheet_rows(sheet.get_rows(first_sheet_row), first_sheet_row)
+    new_rows = database.unappended_rows()
+    if new_rows:
+        database.mark_appended(new_rows, sheet.append_rows(list(new_rows.values())))
+    used_rows = database.unsynced_rows()
+    if used_rows:
+        sheet.write_rows(dict(used_rows.values()))
+        database.mark_synced(used_rows)
+    return n_loaded, len(new_rows), len(used_rows)
+
+
+class DiscountCodes:
+    def __init__(self, store, verbose_level=0, quiet=False):
+        self.store = store
+        self.verbose_level = verbose_level
+        self.quiet = quiet
+
+    def create_new_code(self, name="", scope=[], percentage=10):
+        self.store.connect()
+
+        current_codes = self._current_codes()
+        new_code = self._new_code(current_codes)
+        values = self._new_row(new_code, name, scope, percentage)
+
+        self.store.append_rows([values])
+        if self.verbose_level:
+            print("Row added: ", values)
+
+        if not self.quiet:
+            print(f"New code created for {values[RowIndex.NAME]}: {values[RowIndex.CODE]}")
+            self._print_message_to_send(values[RowIndex.NAME], values[RowIndex.CODE], values[RowIndex.SCOPE].split(","), values[RowIndex.PERCENTAGE])
+
+        return new_code
+
+    def create_new_codes(self, recipients, message_file=None):
+        # Create codes for many (name, scope, percentage) recipients at once:
+        # the codes are made unique against one snapshot of the store and
+        # written with a single append. The messages to send go to
+        # message_file if given. Every recipient is checked and every message
+        # made before anything is stored, so that a bad row stops the whole
+        # batch instead of leaving codes without messages
+        for i, (name, scope, percentage) in enumerate(recipients):
+            if not name.strip():
+                print(f"Recipient {i+1} has no name; no codes were created")
+                sys.exit(1)
+
+        self.store.connect()
+
+        current_codes = self._current_codes()
+        rows = []
+        for name, scope, percentage in recipients:
+            new_code = self._new_code(current_codes)
+            rows.append(self._new_row(new_code, name, scope, percentage))
+        messages = [self._message_to_send(values[RowIndex.NAME], values[RowIndex.CODE], values[RowIndex.SCOPE].split(","), values[RowIndex.PERCENTAGE])
+                    for values in rows]
+
+        self.store.append_rows(rows)
+        if self.verbose_level:
+            print(f"{len(rows)} rows added: ", rows)
+
+        if message_file:
+            with open(message_file, "w") as f:
+                f.write("".join(message + "\n\n" + "-" * 72 + "\n\n" for message in messages))
+        if not self.quiet:
+            for values in rows:
+                print(f"New code created for {values[RowIndex.NAME]}: {values[RowIndex.CODE]}")
+            if message_file:
+                print(f"Messages written to {message_file}")
+
+        return [values[RowIndex.CODE] for values in rows]
+
+    def _current_codes(self):
+        current_codes = self.store.codes()
         if self.verbose_level:
             print("Existing codes: ", ", ".join(current_codes))
+        return current_codes
 
+    def _new_code(self, current_codes):
+        # The new code is added to current_codes, so that codes created one
+        # after another against the same snapshot stay unique
         while True:
             new_code = str(uuid.uuid4())[:8].lower()
             if new_code in current_codes:
@@ -97,7 +736,10 @@ class GoogleSheet:
                     print(f"Code rejected since it already exists; code={new_code}; codes={','.join(current_codes)}")
                 continue
             break
+        current_codes.add(new_code)
+        return new_code
 
+    def _new_row(self, new_code, name, scope, percentage):
         values = [""] * len(list(RowIndex))
         values[RowIndex.CODE] = new_code
         values[RowIndex.T_CREATED] = int(time.time())
@@ -107,26 +749,14 @@ class GoogleSheet:
         values[RowIndex.PERCENTAGE] = percentage
         values[RowIndex.T_USED] = ""
         values[RowIndex.DATE_USED] = self.date_formula(RowIndex.T_USED) if values[RowIndex.T_USED] else ""
-
-        _ = self.sheet.values().append(spreadsheetId=self.sheet_id,
-                                       body={"values": [values]},
-                                       range=self.sheet_tab,
-                                       valueInputOption="USER_ENTERED").execute()
-        if self.verbose_level:
-            print("Row added: ", values)
-
-        if not self.quiet:
-            print(f"New code created for {values[RowIndex.NAME]}: {values[RowIndex.CODE]}")
-            self._print_message_to_send(values[RowIndex.NAME], values[RowIndex.CODE], values[RowIndex.SCOPE].split(","), values[RowIndex.PERCENTAGE])
-
-        return new_code
+        return values
 
     @staticmethod
     def date_formula(index: RowIndex):
         return f"=(INDIRECT(CONCATENATE(\"{chr(index+65)}\",ROW()))/86400)+DATE(1970,1,1)"
     
     @staticmethod
-    def _print_message_to_send(name, code, scope, percentage):
+    def _message_to_send(name, code, scope, percentage):
         first_name = name.split()[0]
         message = f"Hi {first_name},\n\n"
         message += "Thank you for the very useful feedback you gave me in the recent malinensling Expedition! "
@@ -138,40 +768,93 @@ class GoogleSheet:
         message += "Note that this discount code is personal and only valid once.\n\n\n"
         message += "Cheers,\n"
         message += "Malin"
-        print("\nMESSAGE TEMPLATE:")
-        print(message + "\n")
+        return message
 
+    @staticmethod
+    def _print_message_to_send(name, code, scope, percentage):
+        print("\nMESSAGE TEMPLATE:")
+        print(DiscountCodes._message_to_send(name, code, scope, percentage) + "\n")
 
-    def use_code(self, code, name="", wraps=[]):
-        if not self.sheet:
-            self.connect_to_sheet_service()
 
-        current_data = self.sheet.values().get(spreadsheetId=self.sheet_id,
-                                               range=self.sheet_tab).execute().get("values", [])
-        current_codes = [row[RowIndex.CODE].lower() for row in current_data]
-        if self.verbose_level:
-            print("Current codes: ", current_codes)
+    def use_code(self, code, name="", wraps=[], ask=True):
+        self.store.connect()
 
-        code_lower = code.lower()
-        if code_lower not in current_codes:
+        found = self.store.find_code(code)
+        if found is None:
             print(f"Code {code} doesn't exist")
             sys.exit(1)
-        
-        code_index = current_codes.index(code_lower)
-        code_info = current_data[code_index]
+
+        code_index, code_info = found
         if self.verbose_level:
             print("Code info: ", code_info)
 
+        error = self._check_code(code, code_info, name, wraps)
+        if error:
+            print(error)
+            sys.exit(1)
+
+        self._print_code_info(code_info)
+
+        if ask:
+            self._confirm("Do you want to use this code?", "Code was not used")
+
+        self._use_code(code_info, code_index)
+
+    def use_codes(self, requests, check_only=False, ask=True):
+        # Check many (code, name, wraps) requests against one snapshot of the
+        # store and use all the valid codes with a single batch update. A code
+        # can only be used once per batch. Returns a list of (code, error)
+        # where error is None for the valid codes
+        self.store.connect()
+
+        found = self.store.find_codes([code for code, _, _ in requests])
+
+        results = []
+        to_use = {}
+        for code, name, wraps in requests:
+            if code.lower() not in found:
+                error = f"Code {code} doesn't exist"
+                results.append((code, error))
+                continue
+            code_index, code_info = found[code.lower()]
+            if code_index in to_use:
+                error = f"Code {code} is listed more than once"
+            else:
+                code_info = list(code_info)
+                error = self._check_code(code, code_info, name, wraps)
+                if not error:
+                    to_use[code_index] = code_info
+            results.append((code, error))
+
+        if not self.quiet:
+            for code, error in results:
+                print(f"{code}: {error or 'valid'}")
+
+        if check_only or not to_use:
+            return results
+
+        if ask:
+            self._confirm(f"Do you want to use these {len(to_use)} codes?", "Codes were not used")
+
+        used = self._use_codes(to_use)
+        for i, (code, error) in enumerate(results):
+            if not error and found[code.lower()][0] not in used:
+                results[i] = (code, f"Code {code} was used elsewhere in the meantime")
+                if not self.quiet:
+                    print(results[i][1])
+        return results
+
+    @staticmethod
+    def _check_code(code, code_info, name="", wraps=[]):
+        # The reason why code_info cannot be used, or None if it can
         if len(code_info) > RowIndex.T_USED:
             if code_info[RowIndex.T_USED]:
                 date = datetime.fromtimestamp(int(code_info[RowIndex.T_USED])).strftime("%Y-%m-%d %H:%M:%S")
-                print(f"Code {code} was already used on {date}")
-                sys.exit(1)
+                return f"Code {code} was already used on {date}"
 
         code_name = code_info[RowIndex.NAME]
         if name and name != code_name:
-            print(f"Code {code} was not issued to {name} but to {code_name}")
-            sys.exit(1)
+            return f"Code {code} was not issued to {name} but to {code_name}"
 
         scope = code_info[RowIndex.SCOPE]  # No scope means all wraps are covered
         if wraps and scope:
@@ -186,23 +869,19 @@ class GoogleSheet:
                     wrap_string = " or ".join([wraps_string_first_part, not_covered[-1]])
                 else:
                     wrap_string = not_covered[-1]
-                print(f"Code {code} does not cover wrap {wrap_string}")
-                print(f"Wraps covered: {', '.join(scope)}")
-                sys.exit(1)
-
-        self._print_code_info(code_info)
+                return f"Code {code} does not cover wrap {wrap_string}\nWraps covered: {', '.join(scope)}"
+        return None
 
-        ans = input("Do you want to use this code? [y/N] ") or "n"
+    @staticmethod
+    def _confirm(question, output_string):
+        ans = input(f"{question} [y/N] ") or "n"
         if not ans.lower() in ["y", "yes"]:
-            output_string = "Code was not used"
             if ans.lower() in ["n", "no"]:
                 print("Ok, " + output_string.lower())
                 sys.exit(0)
             print(f"Response {ans} not recognised")
             print(output_string)
             sys.exit(1)
-        
-        self._use_code(code_info, code_index+1)
 
     @staticmethod
     def _print_code_info(code_info):
@@ -217,22 +896,31 @@ class GoogleSheet:
         message += f"Wraps:    {wraps}\n"
         message += f"Discount: {code_info[RowIndex.PERCENTAGE]}%\n"
         print(message)
-    
-    def _use_code(self, code_info, row_index):
+
+    def _mark_used(self, code_info):
         if len(code_info) < RowIndex.DATE_USED + 1:
             code_info += [""] * (RowIndex.DATE_USED - len(code_info) + 1)
         code_info[RowIndex.T_USED] = int(time.time())
         code_info[RowIndex.DATE_USED] = self.date_formula(RowIndex.T_USED)
-        range = self.sheet_tab + f"!A{row_index}:{chr(len(RowIndex)-1+65)}{row_index}"
-        if self.verbose_level:
-            print(f"Updating {range} with info={code_info}")
-        self.sheet.values().update(spreadsheetId=self.sheet_id,
-                                   body={"values": [code_info]},
-                                   range=range,
-                                   valueInputOption="USER_ENTERED").execute()
+
+    def _use_codes(self, code_infos):
+        # code_infos maps row index to code info. Returns the indices of the
+        # codes that were used
+        for code_info in code_infos.values():
+            self._mark_used(code_info)
+        used = self.store.use_rows(code_infos)
         if not self.quiet:
-            date = datetime.fromtimestamp(int(code_info[RowIndex.T_USED])).strftime("%Y-%m-%d %H:%M:%S")
-            print(f"Code {code_info[RowIndex.CODE]} was used on {date}")
+            for code_index in used:
+                code_info = code_infos[code_index]
+                date = datetime.fromtimestamp(int(code_info[RowIndex.T_USED])).strftime("%Y-%m-%d %H:%M:%S")
+                print(f"Code {code_info[RowIndex.CODE]} was used on {date}")
+        return used
+
+    def _use_code(self, code_info, code_index):
+        if not self._use_codes({code_index: code_info}):
+            print(f"Code {code_info[RowIndex.CODE]} was used elsewhere in the meantime")
+            sys.exit(1)
+
 
 def main(command_line=None):
     sheet_env_variable_name = "GOOGLE_SHEET_ID"
@@ -255,6 +943,29 @@ def main(command_line=None):
         "--quiet",
         action="store_true",
     )
+    main_parser.add_argument(
+        "-m",
+        "--mirror",
+        default=None,
+        help="file to keep a local copy of the sheet in, so that only new rows are downloaded"
+    )
+    main_parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print call counts, timings and payload sizes of the Google sheet requests as JSON to stderr"
+    )
+    main_parser.add_argument(
+        "--rate_limit",
+        type=int,
+        default=60,
+        help="maximum number of read and of write requests per minute to the Google sheet, 0 for no limit"
+    )
+    main_parser.add_argument(
+        "-D",
+        "--database",
+        default=None,
+        help="SQLite database to keep the codes in instead of the Google sheet"
+    )
 
     subparsers = main_parser.add_subparsers(dest="command")
 
@@ -280,6 +991,29 @@ def main(command_line=None):
         help="scope of discount code, e.g. wrap name"
     )
 
+    bulk_create_parser = subparsers.add_parser("bulk_create", help="create discount codes for everyone in a CSV file",
+                                               description="Create discount codes for everyone in a CSV file with the "
+                                                           "columns name, wraps (comma separated, empty for all) and "
+                                                           "discount (empty for the default)",
+                                               formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    bulk_create_parser.add_argument(
+        "csv_file",
+        help="CSV file with one recipient per row"
+    )
+    bulk_create_parser.add_argument(
+        "-d",
+        "--discount",
+        type=int,
+        default=10,
+        help="discount amount as a percentage, for rows without one"
+    )
+    bulk_create_parser.add_argument(
+        "-o",
+        "--messages",
+        default="messages.txt",
+        help="file to write the messages to send to"
+    )
+
     use_parser = subparsers.add_parser("use", help="use a discount code",
                                        description="Use a discount code",
                                        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -301,24 +1035,103 @@ def main(command_line=None):
         default=[],
         help="wrap to check"
     )
+    use_parser.add_argument(
+        "-y",
+        "--yes",
+        action="store_true",
+        help="use the code without asking"
+    )
+
+    bulk_use_parser = subparsers.add_parser("bulk_use", help="check and use many discount codes",
+                                            description="Check and use the discount codes in a CSV file with the "
+                                                        "columns code, name (empty to not check) and wraps (comma "
+                                                        "separated, empty to not check). Either all the valid codes "
+                                                        "are used or none",
+                                            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    bulk_use_parser.add_argument(
+        "csv_file",
+        help="CSV file with one code per row"
+    )
+    bulk_use_parser.add_argument(
+        "-c",
+        "--check",
+        action="store_true",
+        help="only check the codes, don't use them"
+    )
+    bulk_use_parser.add_argument(
+        "-y",
+        "--yes",
+        action="store_true",
+        help="use the valid codes without asking"
+    )
+
+    subparsers.add_parser("sync", help="sync the database with the Google sheet",
+                          description="Load the codes added to the Google sheet since the last sync into the "
+                                      "database, then append the codes created in the database to the sheet and "
+                                      "mark the codes used in the database as used in the sheet. The first sync "
+                                      "loads the whole sheet",
+                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     args = main_parser.parse_args(command_line)
 
     if args.sheet_id == "$" + sheet_env_variable_name:
         args.sheet_id = os.environ.get(sheet_env_variable_name)
-    if not args.sheet_id:
+    if not args.sheet_id and (not args.database or args.command == "sync"):
         print("\nNo Google sheet ID provided\n")
         main_parser.print_help()
         sys.exit(1)
+    if args.command == "sync" and not args.database:
+        print("\nNo database provided\n")
+        main_parser.print_help()
+        sys.exit(1)
 
-    sheet = GoogleSheet(sheet_id=args.sheet_id, verbose_level=args.verbose, quiet=args.quiet)
-    if args.command == "create":
-        wraps = [Wrap(name) for name in args.wrap]
-        sheet.create_new_code(name=args.name, scope=wraps, percentage=args.discount)
-    elif args.command == "use":
-        wraps = [Wrap(name) for name in args.wrap]
-        sheet.use_code(args.code, name=args.name, wraps=wraps)
+    stats = ApiStats() if args.stats else None
+    if args.database:
+        store = SqliteStore(args.database, verbose_level=args.verbose)
+    else:
+        store = GoogleSheet(sheet_id=args.sheet_id, verbose_level=args.verbose, mirror_file=args.mirror,
+                            stats=stats, rate_limit=args.rate_limit)
+    codes = DiscountCodes(store, verbose_level=args.verbose, quiet=args.quiet)
+    # Every sys.exit() on the way passes through the finally clause
+    try:
+        if args.command == "sync":
+            try:
+                n_loaded, n_appended, n_updated = sync_to_sheet(
+                    store, GoogleSheet(sheet_id=args.sheet_id, verbose_level=args.verbose, stats=stats,
+                                       rate_limit=args.rate_limit))
+            except ValueError as e:
+                print(e)
+                sys.exit(1)
+            if not args.quiet:
+                print(f"{n_loaded} rows loaded from, {n_appended} rows appended to and {n_updated} rows updated "
+                      f"in the sheet")
+        elif args.command == "create":
+            wraps = [Wrap(name) for name in args.wrap]
+            codes.create_new_code(name=args.name, scope=wraps, percentage=args.discount)
+        elif args.command == "bulk_create":
+            recipients = []
+            with open(args.csv_file, newline="") as f:
+                for row in csv.DictReader(f):
+                    wraps = [Wrap(name.strip()) for name in (row.get("wraps") or "").split(",") if name.strip()]
+                    discount = int(row["discount"]) if row.get("discount") else args.discount
+                    recipients.append((row["name"], wraps, discount))
+            codes.create_new_codes(recipients, message_file=args.messages)
+        elif args.command == "use":
+            wraps = [Wrap(name) for name in args.wrap]
+            codes.use_code(args.code, name=args.name, wraps=wraps, ask=not args.yes)
+        elif args.command == "bulk_use":
+            requests = []
+            with open(args.csv_file, newline="") as f:
+                for row in csv.DictReader(f):
+                    wraps = [Wrap(name.strip()) for name in (row.get("wraps") or "").split(",") if name.strip()]
+                    requests.append((row["code"].strip(), row.get("name") or "", wraps))
+            results = codes.use_codes(requests, check_only=args.check, ask=not args.yes)
+            if any(error for _, error in results):
+                sys.exit(1)
 
+    finally:
+        if stats is not None:
+            print(json.dumps(stats.as_dict()), file=sys.stderr)
 
 if __name__ == '__main__':
     main()
@@ -1,45 +1,141 @@
 #!/usr/bin/env python
 
+import argparse
+import hashlib
+import os
 import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+import numpy
 from util import calc
-from util.plotting import draw_plot
-from util.printing import latex_print_string
+from util import encoding
+from util.plotting import draw_plot, draw_preview
+from util.printing import latex_write
 
 N_BRAIDS = 4
 N_PER_LANG_PAIR = 5
+# Width of warp.jpg in pixels (None for one pixel per thread) and its height
+# relative to the width
+PLOT_WIDTH = None
+PLOT_ASPECT = 5
+# Warps wider than this get a tiled preview in warp_preview/ instead of one
+# warp.jpg, rendered from the placement saved to warp.u8
+PREVIEW_MIN_THREADS = 100000
+# Define the colours once in the braid .tex files and use short macros for
+# the threads, optionally boxing runs of one colour together
+LATEX_COLOUR_MACROS = False
+LATEX_GROUP_RUNS = False
 
 
-def read_threads():
-    data = sys.stdin.readlines()
-    threads = []
-    for thread in data[0].split(","):
-        threads.append(thread.strip())
-    return threads
+def read_threads(filename='-'):
+    # Text or raw binary placements, from stdin or a file
+    if filename == '-':
+        return encoding.read_threads(sys.stdin.buffer)
+    with open(filename, 'rb') as f:
+        return encoding.read_threads(f)
 
 
 def get_braids(threads_in, n_braids):
-    threads = threads_in
+    # Braids are slices of the placement array, i.e. views that share its memory
+    threads = numpy.asarray(threads_in)
     n_threads = len(threads)
     n_threads_per_braid = calc.split_threads(n_threads, n_braids, peak_at_center=True, divisible_by=N_PER_LANG_PAIR)
     braids = []
+    start = 0
     for n_threads_in_braid in n_threads_per_braid:
-        braid = []
-        for j in range(n_threads_in_braid):
-            braid.append(threads.pop(0))
-        braids.append(list(braid))
+        braids.append(threads[start:start + n_threads_in_braid])
+        start += n_threads_in_braid
     return braids
 
 
-def main():
-    threads = read_threads()
+def file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_if_changed(filename, write):
+    # Have write() produce the output in a temporary file next to `filename`
+    # and only replace `filename` if the content hash differs, so unchanged
+    # outputs keep their timestamps and downstream LaTeX builds stay
+    # incremental. Returns whether `filename` was (re)written
+    root, extension = os.path.splitext(filename)
+    tmp_filename = root + '.tmp' + str(os.getpid()) + extension
+    try:
+        write(tmp_filename)
+        if os.path.exists(filename) and file_digest(filename) == file_digest(tmp_filename):
+            return False
+        os.replace(tmp_filename, filename)
+        return True
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def write_plot(threads, filename):
+    return write_if_changed(filename,
+                            lambda f: draw_plot(threads, filename=f, width=PLOT_WIDTH, aspect=PLOT_ASPECT))
+
+
+def write_braid(braid, filename):
+    def write(tmp_filename):
+        with open(tmp_filename, 'w') as f:
+            latex_write(braid, f, colour_macros=LATEX_COLOUR_MACROS,
+                        group_runs=LATEX_GROUP_RUNS)
+    return write_if_changed(filename, write)
+
+
+def _submit(executor, func, *args):
+    # Run func in the executor if there is one, or right away otherwise
+    if executor is not None:
+        return executor.submit(func, *args)
+    future = Future()
+    future.set_result(func(*args))
+    return future
+
+
+def write_outputs(threads, directory='.', n_braids=N_BRAIDS, executor=None):
+    # Write the plot (or the tiled preview for very wide warps) and the braid
+    # documents to `directory`. The plot and the braids are independent, so
+    # with an executor they are written concurrently; the tiled preview has a
+    # process pool of its own. Returns (number of threads, rewritten) for
+    # every braid
+    plot = None
+    if len(threads) <= PREVIEW_MIN_THREADS:
+        plot = _submit(executor, write_plot, threads, os.path.join(directory, 'warp.jpg'))
+    braids = get_braids(threads, n_braids)
+    written = [_submit(executor, write_braid, braids[i],
+                       os.path.join(directory, 'braid' + str(i+1) + '.tex'))
+               for i in range(n_braids)]
+    if plot is None:
+        placement_file = os.path.join(directory, 'warp.u8')
+        encoding.save_placement(threads, placement_file)
+        draw_preview(placement_file, os.path.join(directory, 'warp_preview'))
+    else:
+        plot.result()
+    return [(len(braid), future.result()) for braid, future in zip(braids, written)]
+
+
+def main(command_line=None):
+    parser = argparse.ArgumentParser(description="Plot a warp and write its braid documents",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "input",
+        nargs="?",
+        default="-",
+        help="placement to read, as text or raw binary (- for stdin)"
+    )
+    args = parser.parse_args(command_line)
+
+    threads = read_threads(args.input)
     if len(threads) % N_PER_LANG_PAIR != 0:
         print('Warning: the total number of threads is not evenly divisible into lang pairs (%i/%i).\n\r         One braid will have an incomplete lang pair.' % (len(threads), N_PER_LANG_PAIR))
-    draw_plot(threads)
-    braids = get_braids(threads, N_BRAIDS)
-    for i in range(N_BRAIDS):
-        print("Braid " + str(i+1) + ": " + str(len(braids[i])))
-        with open('braid' + str(i+1) + '.tex', 'w') as f:
-            f.write(latex_print_string(braids[i]))
+    with ProcessPoolExecutor() as executor:
+        braids = write_outputs(threads, executor=executor)
+    for i, (n_threads_in_braid, written) in enumerate(braids):
+        unchanged = "" if written else " (unchanged)"
+        print("Braid " + str(i+1) + ": " + str(n_threads_in_braid) + unchanged)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy
+
+
+class PlacementCache:
+    # Content addressed on-disk store of generated placements. Every entry is
+    # a raw uint8 file named after a hash of the parameters that produced it.
+    # Reading an entry marks it as recently used, and once the entries take up
+    # more than max_bytes the least recently used ones are deleted
+    def __init__(self, directory, max_bytes=256 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(params):
+        text = json.dumps(params, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _path(self, params):
+        return os.path.join(self.directory, self.key(params) + ".u8")
+
+    def get(self, params):
+        path = self._path(params)
+        try:
+            placement = numpy.fromfile(path, dtype=numpy.uint8)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return placement
+
+    def put(self, params, placement):
+        # Write to a temporary file first so that concurrent readers never see
+        # a half written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(numpy.asarray(placement, dtype=numpy.uint8).tobytes())
+        os.replace(tmp_path, self._path(params))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".u8"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
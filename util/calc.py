@@ -1,3 +1,6 @@
+import functools
+import math
+import numpy
 
 
 def split_threads(n_threads, n_batches=1, peak_at_center=False, divisible_by=1):
@@ -32,6 +35,13 @@ def split_threads(n_threads, n_batches=1, peak_at_center=False, divisible_by=1):
                          of one batch breaking this constraint
     :return: list of number of threads from batch 0 to batch n_batches-1
     """
+    # The same splits are asked for over and over, so they are memoized. A new
+    # list is handed out every time since callers are free to modify it
+    return list(_split_threads(n_threads, n_batches, peak_at_center, divisible_by))
+
+
+@functools.lru_cache(maxsize=4096)
+def _split_threads(n_threads, n_batches, peak_at_center, divisible_by):
     # Find the largest number divisible by both n_batches and divisible_by
     number_to_split = largest_divisible_by_all(n_threads, [divisible_by, n_batches])
 
@@ -77,7 +87,53 @@ def split_threads(n_threads, n_batches=1, peak_at_center=False, divisible_by=1):
             n_per_batch[i] += divisible_by
         if final_remainder > 0:
             n_per_batch[-1] += final_remainder
-    return n_per_batch
+    return tuple(n_per_batch)
+
+
+def split_table(n_threads, n_batches=1, peak_at_center=False, divisible_by=1):
+    """Split many numbers of threads into batches at once
+
+    Vectorised version of split_threads for a whole range of thread counts, e.g. to
+    compare how different warp widths would be split before picking one.
+
+    Example:
+      table = split_table(range(370, 380), n_batches=[4, 5], peak_at_center=True,
+                          divisible_by=2)
+      table[5][9] == split_threads(379, 5, True, 2)
+
+    :param n_threads: sequence of total numbers of threads
+    :param n_batches: number of batches to split into, or a sequence of them
+    :param peak_at_center: see split_threads
+    :param divisible_by: see split_threads
+    :return: array of shape (len(n_threads), n_batches) where row i is the split of
+             n_threads[i]. If n_batches is a sequence, a dict of such arrays keyed by
+             number of batches
+    """
+    if not numpy.isscalar(n_batches):
+        return {n: split_table(n_threads, n, peak_at_center, divisible_by) for n in n_batches}
+    n_threads = numpy.asarray(n_threads, dtype=numpy.int64)
+    number_to_split = n_threads - n_threads % math.lcm(divisible_by, n_batches)
+    number_to_split[number_to_split <= 0] = 0
+
+    remainder = n_threads - number_to_split
+    final_remainder = remainder % divisible_by
+    n_remainder_batches = (remainder - final_remainder) // divisible_by
+    n_add_none = n_batches - n_remainder_batches
+
+    # Same placement of the remaining threads as in split_threads, as a mask of
+    # the batches getting divisible_by extra threads in every row
+    batch = numpy.arange(n_batches)[numpy.newaxis, :]
+    if peak_at_center:
+        first = (n_add_none // 2)[:, numpy.newaxis]
+        extra = (batch >= first) & (batch < first + n_remainder_batches[:, numpy.newaxis])
+        final_batch = n_batches // 2
+    else:
+        n_first = (n_remainder_batches // 2)[:, numpy.newaxis]
+        extra = (batch < n_first) | (batch >= n_first + n_add_none[:, numpy.newaxis])
+        final_batch = n_batches - 1
+    table = (number_to_split // n_batches)[:, numpy.newaxis] + divisible_by * extra
+    table[:, final_batch] += final_remainder
+    return table
 
 
 def largest_divisible_by_all(number, divisible_by):
@@ -87,24 +143,13 @@ def largest_divisible_by_all(number, divisible_by):
     :param divisible_by: list of integers to check for
     :return: the largest integer evenly divisible by all in divisible_by list
     """
-    # Sort elements largest first; there is no point in checking smaller numbers if the
-    # test number is not divisible by the largest number in the list, and logic is
-    # extended to check numbers largest to smallest
+    # The numbers divisible by all of them are exactly the multiples of their
+    # least common multiple, so round down to the closest one of those
     if isinstance(divisible_by, list):
-        divisible_by_cp = [e for e in divisible_by]
+        lcm = math.lcm(*divisible_by)
     else:
-        divisible_by_cp = [divisible_by]
-    divisible_by_cp.sort(reverse=True)
-    largest_in_list = divisible_by_cp[0]
-    number_to_test = number - (number % largest_in_list)
-    while number_to_test > 0:
-        # Step down by the largest number in the divisible_by list
-        div_by_all = True
-        for test_num in divisible_by_cp[1:]:
-            div_by_all = div_by_all and (number_to_test % test_num == 0)
-            if not div_by_all:
-                break
-        if div_by_all:
-            return number_to_test
-        number_to_test -= largest_in_list
+        lcm = divisible_by
+    number_to_return = number - (number % lcm)
+    if number_to_return > 0:
+        return number_to_return
     return None
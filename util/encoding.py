@@ -0,0 +1,141 @@
+import string
+import numpy
+
+
+# Placements are numpy uint8 arrays holding the colour index of every thread,
+# with EMPTY marking positions that have not been filled, so up to 255
+# colours can be used. As text, colours are written as letters (0 -> A,
+# 1 -> B, ..., 26 -> a, ...) separated by commas, which covers the first
+# len(ALPHABET) colours; placements with any others can only be saved in the
+# raw format (save_placement). Several placements in one text are separated
+# by blank lines
+EMPTY = 255
+EMPTY_CHAR = "-"
+ALPHABET = string.ascii_uppercase + string.ascii_lowercase
+MAX_COLOURS = EMPTY
+
+# Colours without a letter map to _NO_CHAR, which to_string refuses
+_NO_CHAR = ord("?")
+_TO_CHAR = numpy.full(256, _NO_CHAR, dtype=numpy.uint8)
+_TO_CHAR[:len(ALPHABET)] = numpy.frombuffer(ALPHABET.encode("ascii"), dtype=numpy.uint8)
+_TO_CHAR[EMPTY] = ord(EMPTY_CHAR)
+_SKIP = -1
+_FROM_CHAR = numpy.full(256, _SKIP, dtype=numpy.int16)
+_FROM_CHAR[_TO_CHAR[:len(ALPHABET)]] = numpy.arange(len(ALPHABET))
+_FROM_CHAR[ord(EMPTY_CHAR)] = EMPTY
+# What each character is to iter_threads when reading text: a thread, a line
+# break, a separator, or whitespace that is dropped
+_THREAD, _NEWLINE, _OTHER, _SPACE = 0, 1, 2, 3
+_KIND = numpy.full(256, _OTHER, dtype=numpy.int8)
+_KIND[_FROM_CHAR != _SKIP] = _THREAD
+_KIND[ord("\n")] = _NEWLINE
+_KIND[[ord(" "), ord("\t"), ord("\r")]] = _SPACE
+
+
+def empty_placement(n_threads):
+    return numpy.full(n_threads, EMPTY, dtype=numpy.uint8)
+
+
+def to_string(placement, separator=","):
+    placement = numpy.asarray(placement, dtype=numpy.uint8)
+    letters = _TO_CHAR[placement]
+    if numpy.any(letters == _NO_CHAR):
+        colour = int(placement[numpy.argmax(letters == _NO_CHAR)])
+        raise ValueError(f"Colour {colour} has no letter; only the first {len(ALPHABET)} colours can be "
+                         f"written as text")
+    if not separator:
+        return letters.tobytes().decode("ascii")
+    if len(placement) == 0:
+        return ""
+    chars = numpy.full(2 * len(placement) - 1, ord(separator), dtype=numpy.uint8)
+    chars[::2] = letters
+    return chars.tobytes().decode("ascii")
+
+
+def from_string(text):
+    return _decode_text(numpy.frombuffer(text.encode("ascii"), dtype=numpy.uint8))
+
+
+def _decode_text(chars):
+    # Everything but colour letters and the empty marker (separators,
+    # whitespace, line breaks) is skipped
+    threads = _FROM_CHAR[chars]
+    return threads[threads != _SKIP].astype(numpy.uint8)
+
+
+def write_placement(placement, file, separator=",", block_size=1 << 16):
+    # Write the text form block by block, so that only block_size threads are
+    # ever held as text, however wide the warp is
+    for start in range(0, len(placement), block_size):
+        if start:
+            file.write(separator)
+        file.write(to_string(placement[start:start + block_size], separator))
+
+
+def save_placement(placement, path):
+    # Raw uint8 file, one byte per thread, as also used by the placement cache
+    numpy.asarray(placement, dtype=numpy.uint8).tofile(path)
+
+
+def load_placement(path):
+    # Memory-mapped, so only the parts that are actually used are read
+    return numpy.memmap(path, dtype=numpy.uint8, mode="r")
+
+
+def _is_binary(data):
+    # The text format only holds printable ASCII and line breaks, whereas raw
+    # placements are full of small colour indices
+    chars = numpy.frombuffer(data, dtype=numpy.uint8)
+    printable = (chars >= 32) & (chars < 127)
+    whitespace = (chars == ord("\t")) | (chars == ord("\n")) | (chars == ord("\r"))
+    return not numpy.all(printable | whitespace)
+
+
+def iter_threads(file, chunk_size=1 << 20):
+    # Read the first placement from a binary file object chunk_size bytes at
+    # a time and yield its threads as uint8 arrays. Both the text format and
+    # the raw format written by save_placement are accepted; which one it is
+    # gets decided from the first chunk
+    chunk = file.read(chunk_size)
+    if _is_binary(chunk):
+        while chunk:
+            yield numpy.frombuffer(chunk, dtype=numpy.uint8)
+            chunk = file.read(chunk_size)
+        return
+    yield from _iter_text_threads(chunk, file, chunk_size)
+
+
+def _iter_text_threads(chunk, file, chunk_size):
+    # A text placement may be wrapped over several lines as long as every
+    # line but the last ends with a separator, and ends at a blank line, after
+    # which e.g. more candidates from colour_gradient.py may follow. A line
+    # break straight between two threads could be either, so it is refused
+    carry = numpy.array([_OTHER, _OTHER], dtype=numpy.int8)
+    started = False
+    while chunk:
+        chars = numpy.frombuffer(chunk, dtype=numpy.uint8)
+        chars = chars[_KIND[chars] != _SPACE]
+        # The last two characters of the previous chunk come first, so that
+        # line breaks at the chunk boundary are judged like any other
+        kinds = numpy.concatenate((carry, _KIND[chars]))
+        before, centre, after = kinds[:-2], kinds[1:-1], kinds[2:]
+        if numpy.any((centre == _NEWLINE) & (before == _THREAD) & (after == _THREAD)):
+            raise ValueError("Line break between two threads: wrapped placement lines must end with "
+                             "a separator, and placements must be separated by a blank line")
+        has_started = started | (numpy.cumsum(before == _THREAD) > 0)
+        ends = numpy.flatnonzero((centre == _NEWLINE) & (before == _NEWLINE) & has_started)
+        if ends.size:
+            # centre[j] is chars[j - 1]
+            yield _decode_text(chars[:max(ends[0] - 1, 0)])
+            return
+        yield _decode_text(chars)
+        started = started or bool(numpy.any(kinds == _THREAD))
+        carry = kinds[-2:]
+        chunk = file.read(chunk_size)
+
+
+def read_threads(file, chunk_size=1 << 20):
+    placement = bytearray()
+    for threads in iter_threads(file, chunk_size):
+        placement += threads.tobytes()
+    return numpy.frombuffer(placement, dtype=numpy.uint8)
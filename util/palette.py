@@ -0,0 +1,32 @@
+import numpy
+from util import encoding
+
+
+class Palette:
+    # The colours of a design, with lookup tables computed once: rgb is a
+    # uint8 array for mapping whole placements to colours at once
+    # (palette.rgb[placement]), latex holds the colours as "r,g,b" strings,
+    # hex as "#rrggbb" and letters the character each colour is written as,
+    # for the first len(encoding.ALPHABET) colours, which are all that text
+    # and the braid documents can show
+    def __init__(self, colours):
+        if len(colours) > encoding.MAX_COLOURS:
+            raise ValueError(f"A palette can hold at most {encoding.MAX_COLOURS} colours, got {len(colours)}")
+        self.colours = [tuple(colour) for colour in colours]
+        self.rgb = numpy.array(self.colours, dtype=numpy.uint8).reshape(-1, 3)
+        self.latex = [','.join(str(x) for x in colour) for colour in self.colours]
+        self.hex = ['#%02x%02x%02x' % colour for colour in self.colours]
+        self.letters = encoding.to_string(numpy.arange(min(len(self.colours), len(encoding.ALPHABET))),
+                                          separator="")
+
+    def __len__(self):
+        return len(self.colours)
+
+
+DEFAULT_PALETTE = Palette([
+    (65, 60, 90),
+    (180, 140, 175),
+    (225, 190, 200),
+    (250, 250, 225),
+    (250, 245, 155)
+])
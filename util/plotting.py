@@ -1,34 +1,86 @@
-from PIL import Image, ImageDraw
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+from PIL import Image
+from util import encoding
+from util.palette import DEFAULT_PALETTE
 
 
 white = (255, 255, 255)
 black = (0, 0, 0)
 
-COLOURS = [
-    (65, 60, 90),
-    (180, 140, 175),
-    (225, 190, 200),
-    (250, 250, 225),
-    (250, 245, 155)
-]
-
-
-def draw_plot(threads_in):
-    threads = threads_in
-    width = len(threads)
-    height = int(width*5)
-    image = Image.new("RGB", (width, height), black)
-    draw = ImageDraw.Draw(image)
-
-    y0 = 0
-    y1 = height
-    x = 0
-    for t in threads:
-        colour = COLOURS[ord(t) - 65]
-        # PIL (to memory for saving to file)
-        draw.line((x, y0, x, y1), colour)
-        x += 1
+COLOURS = DEFAULT_PALETTE.colours
+
+
+def render_row(threads, width=None, palette=DEFAULT_PALETTE):
+    # One pixel per thread, looked up in the palette for all threads at once.
+    # If a narrower width is asked for, neighbouring threads are averaged
+    row = Image.fromarray(palette.rgb[threads][numpy.newaxis, :, :])
+    if width and width != len(threads):
+        row = row.resize((width, 1), Image.BOX)
+    return row
+
+
+def draw_plot(threads, filename="warp.jpg", width=None, height=None, aspect=5,
+              palette=DEFAULT_PALETTE):
+    # By default the image has one column per thread and is `aspect` times as
+    # tall as it is wide. The single rendered row is stretched to full height
+    width = width or len(threads)
+    height = height or int(width*aspect)
+    image = render_row(threads, width, palette).resize((width, height), Image.NEAREST)
 
     # PIL image can be saved as .png .jpg .gif or .bmp file
-    filename = "warp.jpg"
     image.save(filename)
+
+
+def render_tile(threads, threads_per_pixel, height, chunk_size=1 << 20,
+                palette=DEFAULT_PALETTE):
+    # Average every threads_per_pixel threads into one pixel (the last pixel
+    # may cover fewer). Threads are read chunk_size at a time, so memory use
+    # does not depend on how much of the warp the tile covers
+    rgb = palette.rgb.astype(numpy.float64)
+    n_pixels = -(-len(threads) // threads_per_pixel)
+    row = numpy.empty((n_pixels, 3), dtype=numpy.uint8)
+    pixels_per_chunk = max(1, chunk_size // threads_per_pixel)
+    for first_pixel in range(0, n_pixels, pixels_per_chunk):
+        start = first_pixel * threads_per_pixel
+        chunk = numpy.asarray(threads[start:start + pixels_per_chunk * threads_per_pixel])
+        bounds = numpy.arange(0, len(chunk), threads_per_pixel)
+        sums = numpy.add.reduceat(rgb[chunk], bounds, axis=0)
+        counts = numpy.diff(numpy.append(bounds, len(chunk)))
+        row[first_pixel:first_pixel + len(bounds)] = numpy.rint(sums / counts[:, numpy.newaxis])
+    return Image.fromarray(row[numpy.newaxis, :, :]).resize((n_pixels, height), Image.NEAREST)
+
+
+def _render_tile_file(args):
+    placement_file, start, stop, threads_per_pixel, height, palette, filename = args
+    threads = encoding.load_placement(placement_file)[start:stop]
+    render_tile(threads, threads_per_pixel, height, palette=palette).save(filename)
+    return filename
+
+
+def draw_preview(placement_file, directory="warp_preview", tile_width=2048, height=256,
+                 processes=None, palette=DEFAULT_PALETTE):
+    # Render a warp too wide for draw_plot as a pyramid of tiles, read from a
+    # placement file written with encoding.save_placement. Level 0 holds the
+    # full resolution strips, tile_width threads each, and every level above
+    # halves the resolution until the whole warp fits in one tile:
+    #   <directory>/level<L>/tile<i>.png
+    # Every tile is rendered on its own in a pool of worker processes
+    n_threads = len(encoding.load_placement(placement_file))
+    jobs = []
+    level = 0
+    while True:
+        threads_per_pixel = 2 ** level
+        threads_per_tile = tile_width * threads_per_pixel
+        level_directory = os.path.join(directory, f"level{level}")
+        os.makedirs(level_directory, exist_ok=True)
+        for i, start in enumerate(range(0, n_threads, threads_per_tile)):
+            jobs.append((placement_file, start, min(start + threads_per_tile, n_threads),
+                         threads_per_pixel, height, palette,
+                         os.path.join(level_directory, f"tile{i}.png")))
+        if threads_per_tile >= n_threads:
+            break
+        level += 1
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_render_tile_file, jobs, chunksize=max(1, len(jobs) // 64)))
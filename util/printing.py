@@ -1,20 +1,43 @@
-from util.plotting import COLOURS
+import io
+import itertools
+import numpy
+from util import encoding
+from util.palette import DEFAULT_PALETTE
 
 
-def latex_header():
-    return '\n'.join([r'\documentclass[landscape,a4paper,ms,12pt]{memoir}',
-                      r'\usepackage[margin=1cm]{geometry}',
-                      r'\renewcommand{\baselinestretch}{2.5}',
-                      r'\usepackage{xcolor}',
-                      r'\usepackage[T1]{fontenc}',
-                      r'\def\rangeRGB{255}',
-                      r'\DeclareFontShape{OT1}{cmtt}{bx}{n}{<5><6><7><8><9><10><10.95><12><14.4><17.28><20.74><24.88>cmttb10}{}',
-                      r'\renewcommand{\seriesdefault}{bx}',
-                      r'\setlength\parindent{0pt}',
-                      r'\pagenumbering{gobble}',
-                      r'\begin{document}',
-                      r'\begin{Large}',
-                      ])
+def latex_header(colour_macros=False, palette=DEFAULT_PALETTE):
+    lines = [r'\documentclass[landscape,a4paper,ms,12pt]{memoir}',
+             r'\usepackage[margin=1cm]{geometry}',
+             r'\renewcommand{\baselinestretch}{2.5}',
+             r'\usepackage{xcolor}',
+             r'\usepackage[T1]{fontenc}',
+             r'\def\rangeRGB{255}',
+             r'\DeclareFontShape{OT1}{cmtt}{bx}{n}{<5><6><7><8><9><10><10.95><12><14.4><17.28><20.74><24.88>cmttb10}{}',
+             r'\renewcommand{\seriesdefault}{bx}',
+             r'\setlength\parindent{0pt}',
+             r'\pagenumbering{gobble}',
+             ]
+    if colour_macros:
+        lines += latex_colour_macros(palette)
+    return '\n'.join(lines + [r'\begin{document}',
+                              r'\begin{Large}',
+                              ])
+
+
+def latex_colour_macros(palette=DEFAULT_PALETTE):
+    # Every colour is defined once, together with a macro that boxes threads
+    # in it: \warpcolA{A} for a single thread or \warpcolA{AAA} for a run of
+    # three. The argument is mandatory so that, as with \colorbox, the line
+    # break after it still separates the boxes. The names are longer than
+    # needed so that no letter gives a macro LaTeX already has, as \wp would
+    if len(palette) > len(palette.letters):
+        raise ValueError(f"Colour macros need a letter per colour, so at most {len(encoding.ALPHABET)} "
+                         f"colours, got {len(palette)}")
+    macros = []
+    for letter, colour in zip(palette.letters, palette.latex):
+        macros.append(r'\definecolor{warp' + letter + r'}{RGB}{' + colour + r'}')
+        macros.append(r'\newcommand{\warpcol' + letter + r'}[1]{\colorbox{warp' + letter + r'}{#1}}')
+    return macros
 
 
 def latex_footer():
@@ -24,21 +47,65 @@ def latex_footer():
     ])
 
 
-def latex_print_string(threads_in):
-    threads = threads_in
-    strings = []
+def _latex_box(t, letters, colour_macros, palette):
+    if t >= len(encoding.ALPHABET):
+        raise ValueError(f"Colour {t} has no letter; braid documents can show at most "
+                         f"{len(encoding.ALPHABET)} colours")
+    if colour_macros:
+        return '\\warpcol' + letters[0] + '{' + letters + '}'
+    return r'\colorbox[RGB]{' + palette.latex[t] + r'}{' + letters + r'}'
+
+
+def _latex_items(threads, colour_macros, group_runs, block_size, palette):
+    # Boxes and separators in document order, with a | after every 10th
+    # thread and a line break after every 30th. With group_runs, consecutive
+    # threads of the same colour share a box, but never across a separator
     count = 0
-    while len(threads) > 0:
-        t = threads.pop(0)
-        colour = COLOURS[ord(t)-65]
-        strings.append(r'\colorbox[RGB]{' + ','.join(str(x) for x in colour) + r'}{' + str(t) + r'}')
-        count += 1
-        if count % 30 == 0:
-            strings.append(r'\newline')
-            continue
-        if count % 10 == 0:
-            strings.append(r'|')
-    main_string = "\n".join(strings)
-    return '\n'.join([latex_header(),
-                      main_string,
-                      latex_footer()])
\ No newline at end of file
+    run_colour = None
+    run_letters = ''
+    for start in range(0, len(threads), block_size):
+        block = threads[start:start + block_size]
+        letters = encoding.to_string(block, separator="")
+        for t, letter in zip(block.tolist(), letters):
+            if run_letters and (t != run_colour or not group_runs):
+                yield _latex_box(run_colour, run_letters, colour_macros, palette)
+                run_letters = ''
+            run_colour = t
+            run_letters += letter
+            count += 1
+            if count % 10 == 0:
+                yield _latex_box(run_colour, run_letters, colour_macros, palette)
+                run_letters = ''
+                yield r'\newline' if count % 30 == 0 else r'|'
+    if run_letters:
+        yield _latex_box(run_colour, run_letters, colour_macros, palette)
+
+
+def latex_write(threads_in, file, block_size=3000, colour_macros=False, group_runs=False,
+                palette=DEFAULT_PALETTE):
+    # Write the document to `file` block_size items at a time, without
+    # holding the whole document in memory or modifying threads_in.
+    # colour_macros defines the colours once in the preamble and uses short
+    # per-colour macros for the threads instead of spelling out the RGB
+    # values every time; group_runs boxes runs of one colour together
+    threads = numpy.asarray(threads_in)
+    file.write(latex_header(colour_macros, palette) + '\n')
+    items = _latex_items(threads, colour_macros, group_runs, block_size, palette)
+    first = True
+    while True:
+        strings = list(itertools.islice(items, block_size))
+        if not strings:
+            break
+        if not first:
+            file.write('\n')
+        file.write('\n'.join(strings))
+        first = False
+    file.write('\n' + latex_footer())
+
+
+def latex_print_string(threads_in, colour_macros=False, group_runs=False,
+                       palette=DEFAULT_PALETTE):
+    output = io.StringIO()
+    latex_write(threads_in, output, colour_macros=colour_macros, group_runs=group_runs,
+                palette=palette)
+    return output.getvalue()
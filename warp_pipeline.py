@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import colour_gradient
+import plt_warp
+from util.cache import PlacementCache
+
+
+def run_design(spec, output_dir=".", cache=None):
+    # Generate one design and write its plot and braid documents, all in this
+    # process with the placement kept in memory. Apart from "name", "seed"
+    # and "n_braids", the keys of `spec` are WarpConfig parameters, e.g.
+    #   {"name": "sunrise", "n_threads": 523, "sigma": 60.0, "seed": 2}
+    spec = dict(spec)
+    name = spec.pop("name")
+    seed = spec.pop("seed", None)
+    n_braids = spec.pop("n_braids", plt_warp.N_BRAIDS)
+    config = colour_gradient.WarpConfig(**spec)
+    placement = colour_gradient.generate_placement(config, seed, cache)
+    directory = os.path.join(output_dir, name)
+    os.makedirs(directory, exist_ok=True)
+    braids = plt_warp.write_outputs(placement, directory, n_braids)
+    return name, len(placement), braids
+
+
+def _run_design(args):
+    return run_design(*args)
+
+
+def run_designs(specs, output_dir=".", processes=None, cache=None):
+    # Designs are spread over a process pool, each running the whole pipeline
+    # on its own. A single design is run in this process
+    jobs = [(spec, output_dir, cache) for spec in specs]
+    if len(jobs) == 1:
+        return [_run_design(jobs[0])]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_run_design, jobs))
+
+
+def main(command_line=None):
+    parser = argparse.ArgumentParser(description="Generate warps and write their plots and braid documents",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "specs",
+        help="JSON file with a design spec or a list of them (- for stdin)"
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        default=".",
+        help="directory to write one subdirectory per design to"
+    )
+    parser.add_argument(
+        "-j",
+        "--processes",
+        type=int,
+        default=None,
+        help="number of worker processes (default: one per CPU)"
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="directory to cache seeded placements in"
+    )
+    args = parser.parse_args(command_line)
+
+    if args.specs == "-":
+        specs = json.load(sys.stdin)
+    else:
+        with open(args.specs) as f:
+            specs = json.load(f)
+    if isinstance(specs, dict):
+        specs = [specs]
+    for i, spec in enumerate(specs):
+        spec.setdefault("name", "design" + str(i+1))
+
+    cache = PlacementCache(args.cache_dir) if args.cache_dir else None
+    for name, n_threads, braids in run_designs(specs, args.output_dir, args.processes, cache):
+        sizes = ", ".join(str(n_threads_in_braid) for n_threads_in_braid, _ in braids)
+        print(f"{name}: {n_threads} threads, braids {sizes}")
+
+
+if __name__ == "__main__":
+    main()